@@ -0,0 +1,213 @@
+#
+# -*- coding: utf-8-*-
+# Benchmark of complete scans against local stand-in servers.
+#
+# Usage: python bench/run.py [--targets=10,100,1000,10000] [--save-baseline]
+#
+# (c) ISC Clemenz & Weinbrecht GmbH 2018
+#
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+# measure the working tree, not an installed pmon
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+# metric -> True if higher is better
+METRICS = {'wall_s': False,
+           'checks_per_s': True,
+           'rss_mb': False,
+           'save_s': False,
+           'notify_s': False}
+
+
+def write_config(directory, args):
+    """
+    Configuration of a benchmark run, every HTTP target can fall
+    back to the SSH sensors of the stand-in SSH host.
+    :return: name of the config file
+    """
+    lines = ['[pmon]',
+             'id=bench',
+             'data.file={0}'.format(os.path.join(directory, 'pmon.json')),
+             'latest.file={0}'.format(os.path.join(directory, 'current.json')),
+             'log.file={0}'.format(os.path.join(directory, 'pmon.log')),
+             'log.level=ERROR',
+             'timeout=10',
+             'scan.workers={0}'.format(args.workers),
+             # all targets share one host, the host limit would serialize them
+             'scan.workers.host={0}'.format(args.workers),
+             'http.mode={0}'.format(args.mode),
+             'http.pool.size={0}'.format(args.workers * 4),
+             'http.pool.host={0}'.format(args.workers * 4),
+             'ssh.batch={0}'.format(args.ssh_batch),
+             '',
+             '[urls]']
+    remote = ['', '[remote]']
+    for n in range(args.child):
+        key = 'url.{0}'.format(n + 1)
+        lines.append('{0} = http://127.0.0.1:{1}/t/{2}'.format(key, args.http_port, n + 1))
+        remote.extend(['{0}.user = pi'.format(key),
+                       '{0}.pwd = raspberry'.format(key),
+                       '{0}.port = {1}'.format(key, args.ssh_port),
+                       '{0}.type = ssh'.format(key),
+                       '{0}.process = python com_srv.py'.format(key),
+                       '{0}.scan_cmd = ps aux'.format(key),
+                       '{0}.log.dir = /var/log/app'.format(key),
+                       '{0}.log.files = *.log'.format(key),
+                       '{0}.log.pattern = ERROR'.format(key)])
+    lines.extend(remote)
+    lines.extend(['',
+                  '[email]',
+                  'server=127.0.0.1',
+                  'port={0}'.format(args.smtp_port),
+                  'pwd=bench',
+                  'from=pmon@bench.local',
+                  'to=ops@bench.local'])
+    name = os.path.join(directory, 'bench.ini')
+    with open(name, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    return name
+
+
+def run_child(args):
+    """
+    One scan of args.child targets in this process.
+    :return: dict of the measured values
+    """
+    import pmon
+
+    spent = {'__save_data': 0.0, 'notify': 0.0}
+
+    def timed(name):
+        original = vars(pmon)[name]
+
+        def wrapper(*a, **kw):
+            start = time.perf_counter()
+            try:
+                return original(*a, **kw)
+            finally:
+                spent[name] += time.perf_counter() - start
+        setattr(pmon, name, wrapper)
+
+    with tempfile.TemporaryDirectory(prefix='pmon-bench-') as directory:
+        pmon.init(write_config(directory, args))
+        timed('__save_data')
+        timed('notify')
+        start = time.perf_counter()
+        pmon.execute_scan(False)
+        wall = time.perf_counter() - start
+        pmon.close()
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    rss_mb = rss / (1024.0 * 1024.0) if sys.platform == 'darwin' else rss / 1024.0
+    return {'targets': args.child,
+            'wall_s': round(wall, 4),
+            'checks_per_s': round(args.child / wall, 2),
+            'rss_mb': round(rss_mb, 1),
+            'save_s': round(spent['__save_data'], 4),
+            'notify_s': round(spent['notify'], 4)}
+
+
+def compare(results, baseline, tolerance):
+    """
+    Print the results next to the baseline.
+    :return: number of metrics worse than the baseline by more than the tolerance
+    """
+    regressions = 0
+    print('{0:>8} {1:>14} {2:>12} {3:>12} {4:>9}'.format('targets', 'metric', 'value', 'baseline', 'change'))
+    for result in results:
+        base = baseline.get(str(result['targets']), dict())
+        for metric, higher_better in METRICS.items():
+            value = result[metric]
+            reference = base.get(metric)
+            change = ''
+            if reference:
+                delta = (value - reference) / reference
+                change = '{0:+.1%}'.format(delta)
+                worse = -delta if higher_better else delta
+                if worse > tolerance:
+                    change += ' !'
+                    regressions += 1
+            print('{0:>8} {1:>14} {2:>12} {3:>12} {4:>9}'.format(result['targets'], metric, value,
+                                                                 '-' if reference is None else reference, change))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of pmon scans against local stand-in servers.")
+    parser.add_argument('--targets', type=str, default='10,100,1000,10000',
+                        help="comma separated numbers of targets")
+    parser.add_argument('--mode', type=str, default='sync', help="http.mode of the scans, sync or async")
+    parser.add_argument('--workers', type=int, default=8, help="scan.workers of the scans")
+    parser.add_argument('--latency', type=float, default=0.02, help="mean answer delay of the HTTP targets")
+    parser.add_argument('--spread', type=float, default=0.01, help="random deviation of the answer delay")
+    parser.add_argument('--errors', type=float, default=0.01, help="share of HTTP answers with status 500")
+    parser.add_argument('--ssh-batch', type=bool, default=False, help="ssh.batch of the scans")
+    parser.add_argument('--baseline', type=str, default=os.path.join(BENCH_DIR, 'baseline.json'),
+                        help="file with the baseline results")
+    parser.add_argument('--save-baseline', type=bool, default=False,
+                        help="store the results as new baseline")
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help="allowed relative regression against the baseline")
+    # internal, a single measurement in a fresh process
+    parser.add_argument('--child', type=int, default=0, help=argparse.SUPPRESS)
+    parser.add_argument('--http-port', type=int, default=0, help=argparse.SUPPRESS)
+    parser.add_argument('--ssh-port', type=int, default=0, help=argparse.SUPPRESS)
+    parser.add_argument('--smtp-port', type=int, default=0, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run_child(args)))
+        return 0
+
+    from standins import StandInHttpServer, StandInSshServer, StandInSmtpServer
+    http_server = StandInHttpServer(0, args.latency, args.spread, args.errors, 512).start()
+    ssh_server = StandInSshServer(0).start()
+    smtp_server = StandInSmtpServer(0).start()
+    results = list()
+    try:
+        for count in [int(n) for n in args.targets.split(',')]:
+            command = [sys.executable, os.path.abspath(__file__),
+                       '--child={0}'.format(count),
+                       '--mode={0}'.format(args.mode),
+                       '--workers={0}'.format(args.workers),
+                       '--http-port={0}'.format(http_server.port),
+                       '--ssh-port={0}'.format(ssh_server.port),
+                       '--smtp-port={0}'.format(smtp_server.port)]
+            if args.ssh_batch:
+                command.append('--ssh-batch=True')
+            output = subprocess.run(command, stdout=subprocess.PIPE, check=True).stdout
+            result = json.loads(output.decode('utf-8').strip().split('\n')[-1])
+            print('{0} targets: {1} s, {2} checks/s'.format(count, result['wall_s'], result['checks_per_s']),
+                  file=sys.stderr)
+            results.append(result)
+    finally:
+        http_server.stop()
+        ssh_server.stop()
+        smtp_server.stop()
+
+    baseline = dict()
+    if os.path.isfile(args.baseline):
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+    regressions = compare(results, baseline, args.tolerance)
+    if args.save_baseline:
+        baseline.update({str(r['targets']): {k: r[k] for k in METRICS} for r in results})
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print('Baseline saved to {0}'.format(args.baseline))
+        return 0
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
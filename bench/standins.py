@@ -0,0 +1,279 @@
+#
+# -*- coding: utf-8-*-
+# Local stand-in servers for the benchmarks: HTTP targets,
+# SSH hosts and a mail server.
+#
+# (c) ISC Clemenz & Weinbrecht GmbH 2018
+#
+
+import http.server
+import random
+import re
+import socket
+import socketserver
+import threading
+import time
+
+import paramiko
+
+PS_OUTPUT = ('USER       PID %CPU %MEM    VSZ   RSS TTY      STAT START   TIME COMMAND\n'
+             'root         1  0.0  0.1 167736 11520 ?        Ss   Jul17   0:04 /sbin/init\n'
+             'pi         812  0.3  1.2  52340 12044 ?        Sl   Jul17   2:11 python com_srv.py\n'
+             'mysql      901  0.5  8.1 643236 81456 ?        Ssl  Jul17   5:42 /usr/sbin/mysqld\n')
+DF_OUTPUT = ('Filesystem     1K-blocks    Used Available Use% Mounted on\n'
+             '/dev/root       30398568 6021188  23081148  21% /\n'
+             'tmpfs             494412       0    494412   0% /dev/shm\n')
+MEM_OUTPUT = ('MemTotal:         988824 kB\n'
+              'MemFree:          132412 kB\n'
+              'MemAvailable:     612340 kB\n'
+              'Cached:           401244 kB\n'
+              'SwapCached:            0 kB\n'
+              'SwapTotal:        102396 kB\n'
+              'SwapFree:         102396 kB\n')
+LOG_LINES = ('2018-07-17 00:16:45 ERROR connection refused\n'
+             '2018-07-17 00:16:46 ERROR retry failed\n')
+
+
+class StandInHttpServer(object):
+    """
+    HTTP server answering every GET after a latency with a random
+    spread. A share of the requests is answered with status 500.
+    """
+    server = None
+    thread = None
+
+    def __init__(self, port, latency, spread, error_rate, body_size):
+        """
+        Constructor.
+        :param port: port to listen on, 0 for any free one
+        :param latency: mean delay of an answer in seconds
+        :param spread: maximum random deviation of the delay in seconds
+        :param error_rate: share of requests answered with 500, 0.0 to 1.0
+        :param body_size: size of the answer in bytes
+        """
+        body = b'x' * body_size
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                delay = latency + random.uniform(-spread, spread)
+                if delay > 0:
+                    time.sleep(delay)
+                status = 500 if random.random() < error_rate else 200
+                self.send_response(status)
+                self.send_header('Content-Type', 'text/plain')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.server.daemon_threads = True
+        self.server.request_queue_size = 1024
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name='bench-http', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class _SshServer(paramiko.ServerInterface):
+    """
+    Accepts any password and answers the commands of the sensors
+    with canned output, nothing is executed.
+    """
+    FOR_LOOP = re.compile(r'^for f in (\S+); do$')
+    LOG_MARKER = re.compile(r'echo "(\S+) \$ino')
+    ECHO = re.compile(r"^echo '(.*)'$")
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED
+
+    @classmethod
+    def answer(cls, script):
+        """
+        :param script: a command or a script of the sensors
+        :return: the canned output
+        """
+        out = list()
+        lines = script.split('\n')
+        n = 0
+        while n < len(lines):
+            line = lines[n].strip()
+            n += 1
+            echo = cls.ECHO.match(line)
+            loop = cls.FOR_LOOP.match(line)
+            if echo:
+                out.append(echo.group(1) + '\n')
+            elif loop:
+                body = list()
+                while n < len(lines) and lines[n].strip() != 'done':
+                    body.append(lines[n])
+                    n += 1
+                n += 1
+                marker = cls.LOG_MARKER.search('\n'.join(body))
+                pattern = loop.group(1).replace('*', 'app')
+                if marker:
+                    out.append('{0} 4711 {1} 0 {2}\n'.format(marker.group(1), len(LOG_LINES), pattern))
+                out.append(LOG_LINES)
+            elif 'meminfo' in line:
+                out.append(MEM_OUTPUT)
+            elif line.startswith('df'):
+                out.append(DF_OUTPUT)
+            elif 'grep' in line:
+                out.append(LOG_LINES)
+            elif 'mysqladmin' in line:
+                out.append('mysqld is alive\n')
+            elif line.startswith('ps') or ' ps ' in line:
+                out.append(PS_OUTPUT)
+        return ''.join(out).encode('utf-8')
+
+    def check_channel_exec_request(self, channel, command):
+        def reply():
+            channel.sendall(self.answer(command.decode('utf-8')))
+            channel.send_exit_status(0)
+            # only EOF, closing could overtake the acknowledge of the
+            # request; wait for the client to close its side instead
+            channel.shutdown_write()
+            while channel.recv(1024):
+                pass
+            channel.close()
+        threading.Thread(target=reply, daemon=True).start()
+        return True
+
+
+class StandInSshServer(object):
+    """
+    SSH server on top of paramiko answering ps, df, meminfo and the
+    log scans of the sensors.
+    """
+    sock = None
+    thread = None
+    key = None
+    connections = 0
+    stopped = False
+
+    def __init__(self, port):
+        """
+        Constructor.
+        :param port: port to listen on, 0 for any free one
+        """
+        self.key = paramiko.RSAKey.generate(2048)
+        self.sock = socket.socket()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', port))
+        self.sock.listen(128)
+
+    @property
+    def port(self):
+        return self.sock.getsockname()[1]
+
+    def __serve(self, conn):
+        transport = paramiko.Transport(conn)
+        transport.add_server_key(self.key)
+        transport.start_server(server=_SshServer())
+        # the transport only holds weak references to its channels,
+        # an unreferenced channel is closed while still in use
+        channels = set()
+        while transport.is_active() and not self.stopped:
+            channel = transport.accept(1)
+            if channel is not None:
+                channels = {c for c in channels if not c.closed}
+                channels.add(channel)
+        transport.close()
+
+    def __accept(self):
+        while not self.stopped:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            self.connections += 1
+            threading.Thread(target=self.__serve, args=(conn,), daemon=True).start()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.__accept, name='bench-ssh', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped = True
+        self.sock.close()
+
+
+class StandInSmtpServer(object):
+    """
+    Mail sink speaking enough SMTP for smtplib, the mails are counted
+    and dropped.
+    """
+    server = None
+    thread = None
+    mails = 0
+    connections = 0
+
+    def __init__(self, port):
+        """
+        Constructor.
+        :param port: port to listen on, 0 for any free one
+        """
+        sink = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def reply(self, line):
+                self.wfile.write((line + '\r\n').encode('ascii'))
+
+            def handle(self):
+                sink.connections += 1
+                self.reply('220 pmon bench sink')
+                for line in self.rfile:
+                    command = line.decode('ascii', 'replace').strip().upper()
+                    if command.startswith('EHLO'):
+                        self.reply('250-pmon bench sink')
+                        self.reply('250 AUTH PLAIN LOGIN')
+                    elif command.startswith('AUTH'):
+                        self.reply('235 Authentication successful')
+                    elif command == 'DATA':
+                        self.reply('354 End data with <CR><LF>.<CR><LF>')
+                        for data in self.rfile:
+                            if data in (b'.\r\n', b'.\n'):
+                                break
+                        sink.mails += 1
+                        self.reply('250 Queued')
+                    elif command == 'QUIT':
+                        self.reply('221 Bye')
+                        return
+                    else:
+                        self.reply('250 OK')
+
+        self.server = socketserver.ThreadingTCPServer(('127.0.0.1', port), Handler)
+        self.server.daemon_threads = True
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name='bench-smtp', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
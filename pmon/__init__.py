@@ -10,22 +10,81 @@ import json
 import logging
 import logging.handlers
 import os
-import smtplib
+import threading
+import time
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from string import Template
 
 import requests
 
+from pmon.async_http import PmonAsyncHttp
+from pmon.history import PmonHistory, PmonHistoryView
+from pmon.http_timing import start_timing, stop_timing, timed_session
+from pmon.mailer import PmonMailer
+from pmon.metrics import PmonMetrics
+from pmon.retention import PmonRetention
+from pmon.run_stats import PmonRunStats
+from pmon.scanner import PmonScanner
+from pmon.scheduler import PmonScheduler
+from pmon.sqlite_history import PmonSqliteHistory
+from pmon.ssh_pool import PmonSshPool
 from pmon.srvr import PmonServer
 from pmon.ssh_sensor import PmonSensor
+from pmon.targets import load_targets
 
 name = 'pmon'
 
 LOG = None
 CFG = None
+# compiled targets of CFG, both are replaced at once on reload
+TARGETS = None
+# name and (mtime, size) of the config file read last
+CONFIG_NAME = None
+CONFIG_STAT = None
+# serializes reloads of the configuration
+RELOAD_LOCK = threading.Lock()
+# callables(cfg) informed about a reloaded configuration
+RELOAD_LISTENERS = list()
+# lazy url -> records view on HISTORY, read on access only
 DATA = None
 THIS_RUN = None
+HISTORY = None
+RETENTION = None
+# records of the current run not yet appended to HISTORY
+NEW_RECORDS = None
+# guards THIS_RUN and NEW_RECORDS while checks run concurrently
+LOCK = threading.Lock()
+# serializes complete scans, e.g. forced ones from the server
+SCAN_LOCK = threading.Lock()
+# shared asyncio HTTP checker, created on first use with http.mode=async
+ASYNC_HTTP = None
+# guards the creation of ASYNC_HTTP by concurrent checks
+ASYNC_LOCK = threading.Lock()
+# scheduler of the daemon mode, None if not running as daemon
+SCHEDULER = None
+# callables(url, record) informed about every finished check
+LISTENERS = list()
+# callables(url, record) informed about every check appended to HISTORY
+HISTORY_LISTENERS = list()
+# aggregated metrics of the checks and scans
+METRICS = None
+# sender of the notification mails
+MAILER = None
+# url -> up of the last notification and time of the last digest
+MAIL_STATE = None
+# durations of the phases and checks of the current run
+RUN_STATS = None
+# maximum seconds between two evictions of idle SSH connections
+SSH_EVICT_INTERVAL = 60
+
+# HTTP status codes counting as a successful check
+HTTP_ACCEPTED = (requests.codes.ok,
+                 requests.codes.accepted,
+                 requests.codes.created,
+                 requests.codes.found,
+                 requests.codes.unauthorized,
+                 requests.codes.payment)
 
 
 def init(config_name):
@@ -34,7 +93,10 @@ def init(config_name):
     :param config_name: name of the config file
     :return:
     """
-    global LOG, CFG, DATA, THIS_RUN
+    global LOG, CFG, DATA, THIS_RUN, HISTORY, NEW_RECORDS, RETENTION, METRICS, MAILER, MAIL_STATE, RUN_STATS
+    global TARGETS, CONFIG_NAME, CONFIG_STAT
+    RUN_STATS = PmonRunStats()
+    config_start = time.monotonic()
 
     # 1. Configuration
     CFG = configparser.ConfigParser()
@@ -42,7 +104,10 @@ def init(config_name):
     if not os.path.isfile(config_name):
         raise Exception('Config file not found: ' + config_name)
 
+    CONFIG_NAME = config_name
+    CONFIG_STAT = __config_stat()
     CFG.read(config_name)
+    TARGETS = load_targets(CFG)
 
     # 2. Init logging
     LOG = logging.getLogger('pmon')
@@ -67,15 +132,58 @@ def init(config_name):
     LOG.addHandler(rh)
     LOG.addHandler(ch)
     LOG.info('PMON initialized(' + CFG['pmon']['id'] + ')')
-
-    # 3. load data file
-    if os.path.isfile(CFG['pmon']['data.file']) and os.path.getsize(CFG['pmon']['data.file']) > 0:
-        with open(CFG['pmon']['data.file'], 'r') as f:
-            DATA = json.load(f)
+    RUN_STATS.add_phase('config', time.monotonic() - config_start)
+
+    # 3. open history, the former data file is migrated once
+    history_start = time.monotonic()
+    data_file = CFG['pmon']['data.file']
+    backend = CFG['pmon'].get('history.backend', fallback='jsonl')
+    if backend == 'sqlite':
+        HISTORY = PmonSqliteHistory(LOG,
+                                    CFG['pmon'].get('history.db',
+                                                    fallback=os.path.splitext(data_file)[0] + '.sqlite'))
+    elif backend == 'jsonl':
+        history_dir = CFG['pmon'].get('history.dir', fallback=os.path.splitext(data_file)[0] + '.history')
+        HISTORY = PmonHistory(LOG,
+                              history_dir,
+                              CFG['pmon'].getint('history.segment.size', fallback=4) * 1024 * 1024)
+    else:
+        raise Exception('Unsupported history.backend: ' + backend)
+    if HISTORY.is_empty() and os.path.isfile(data_file) and os.path.getsize(data_file) > 0:
+        HISTORY.migrate(data_file)
+    DATA = PmonHistoryView(HISTORY)
+    RUN_STATS.add_phase('history', time.monotonic() - history_start)
+    RETENTION = PmonRetention(CFG['pmon'].getint('retention.raw.days', fallback=0),
+                              CFG['pmon'].getint('retention.hourly.days', fallback=30),
+                              CFG['pmon'].getint('retention.daily.days', fallback=0))
+
+    # 4. SSH connections are reused by all sensors
+    ssh_idle = CFG['pmon'].getint('ssh.pool.idle', fallback=300)
+    if ssh_idle > 0 and PmonSensor.pool is None:
+        PmonSensor.pool = PmonSshPool(LOG, ssh_idle)
+
+    # 5. metrics are counted while the checks finish
+    if METRICS is not None:
+        remove_listener(METRICS.observe)
+    buckets = CFG['pmon'].get('metrics.buckets', fallback='')
+    if buckets.strip():
+        METRICS = PmonMetrics([float(b) for b in buckets.split(',')])
     else:
-        DATA = dict()
+        METRICS = PmonMetrics()
+    add_listener(METRICS.observe)
+
+    # 6. mail connection, opened when a mail is sent, and the state
+    # reported last, read before this run replaces the latest results
+    if CFG.has_section('email'):
+        MAIL_STATE = __load_mail_state()
+        MAILER = PmonMailer(LOG,
+                            CFG.get('email', 'server'),
+                            int(CFG.get('email', 'port')),
+                            CFG.get('email', 'from'),
+                            CFG['email']['pwd'])
 
     THIS_RUN = dict()
+    NEW_RECORDS = list()
 
 
 def __datetime_converter(o):
@@ -88,20 +196,88 @@ def __datetime_converter(o):
         return o.__str__()
 
 
-def __http_scan(cfg_name):
+def __config_stat():
+    global CONFIG_NAME
+    try:
+        stat = os.stat(CONFIG_NAME)
+        return stat.st_mtime_ns, stat.st_size
+    except OSError:
+        return None
+
+
+def reload():
+    """
+    Read the config file again and replace configuration and targets
+    at once. Checks in flight finish with the targets they started
+    with, their results are kept. An invalid file is logged and the
+    current configuration stays in use.
+    Settings read at startup, like history, server, logging and mail
+    server, require a restart.
+    :return: True if the configuration has been replaced
+    """
+    global LOG, CFG, TARGETS, CONFIG_STAT, THIS_RUN, SCHEDULER
+    with RELOAD_LOCK:
+        stat = __config_stat()
+        cfg = configparser.ConfigParser()
+        try:
+            if not cfg.read(CONFIG_NAME):
+                raise Exception('Config file not found: ' + CONFIG_NAME)
+            targets = load_targets(cfg)
+        except Exception as x:
+            # not tried again until the file changes
+            CONFIG_STAT = stat
+            LOG.error('Configuration not reloaded, keeping the current one: ' + str(x))
+            return False
+        CFG, TARGETS, CONFIG_STAT = cfg, targets, stat
+        with LOCK:
+            for url in [u for u in THIS_RUN if u not in targets.by_url]:
+                del THIS_RUN[url]
+        if SCHEDULER is not None:
+            SCHEDULER.update_checks([(t.key, t.url, t.interval, t.jitter) for t in targets], check_target)
+        for listener in list(RELOAD_LISTENERS):
+            try:
+                listener(cfg)
+            except Exception as x:
+                LOG.error('Reload listener failed: {0}'.format(str(x)))
+        LOG.info('Configuration reloaded, {0} targets'.format(len(targets)))
+        return True
+
+
+def add_reload_listener(listener):
+    """
+    Register a callable informed about every reloaded configuration.
+    :param listener: callable(cfg), called in the thread of the reload
+    :return: None
+    """
+    RELOAD_LISTENERS.append(listener)
+
+
+def reload_if_changed():
+    """
+    Reload the configuration if the config file changed.
+    :return: True if the configuration has been replaced
+    """
+    global CONFIG_STAT
+    if __config_stat() == CONFIG_STAT:
+        return False
+    return reload()
+
+
+def __http_scan(target):
     global LOG, CFG, DATA, THIS_RUN
-    url = CFG['urls'][cfg_name]
+    url = target.url
     LOG.info("Checking url: " + url)
     record = dict()
+    start = time.monotonic()
+    start_timing()
     try:
         record['time'] = datetime.datetime.now()
-        rsp = requests.get(url, timeout=int(CFG['pmon']['timeout']))
-        if rsp.status_code in [requests.codes.ok,
-                               requests.codes.accepted,
-                               requests.codes.created,
-                               requests.codes.found,
-                               requests.codes.unauthorized,
-                               requests.codes.payment]:
+        with timed_session() as session:
+            rsp = session.get(url, timeout=int(CFG['pmon']['timeout']))
+        record['duration'] = round(time.monotonic() - start, 6)
+        record['timing'] = stop_timing()
+        record['size'] = len(rsp.content)
+        if rsp.status_code in HTTP_ACCEPTED:
             LOG.info("Check succeeded")
             record['result'] = 'SUCCESS'
             record['message'] = 'OK'
@@ -109,52 +285,106 @@ def __http_scan(cfg_name):
             LOG.warning("Check failed with status: " + str(rsp.status_code))
             record['result'] = 'APPLICATION_ERROR'
             record['message'] = rsp.status_code
-            PmonSensor.all_sensors(LOG, CFG, cfg_name, record)
+            PmonSensor.all_sensors(LOG, CFG, target, record)
     except Exception as x:
+        record['duration'] = round(time.monotonic() - start, 6)
+        record['timing'] = stop_timing()
         LOG.error("Check failed due: " + str(x))
         record['result'] = 'EXCEPTION_ERROR'
         record['message'] = str(x)
-        PmonSensor.all_sensors(LOG, CFG, cfg_name, record)
-    if url in DATA:
-        DATA[url].append(record)
-    else:
-        url_lines = list()
-        url_lines.append(record)
-        DATA[url] = url_lines
+        PmonSensor.all_sensors(LOG, CFG, target, record)
+    __store_http_record(target, record)
+
 
-    THIS_RUN[url] = record
+def __store_http_record(target, record):
+    """
+    Add the record of a HTTP check to the history and the latest results.
+    :param target: the checked PmonTarget
+    :param record: result of the check
+    :return:
+    """
+    global CFG, THIS_RUN, NEW_RECORDS
+    url = target.url
+    with LOCK:
+        NEW_RECORDS.append((url, record))
+        THIS_RUN[url] = record
+    __publish(url, record, True)
 
 
-def __check_ssh_mysql(cfg_name):
+def __check_ssh_mysql(target):
     global LOG, CFG, DATA, THIS_RUN
-    url = CFG['urls'][cfg_name]
+    url = target.url
     LOG.info("Checking url: " + url)
     record = dict()
     record['time'] = datetime.datetime.now()
     try:
-        with PmonSensor(LOG, CFG, cfg_name, record) as s:
+        with PmonSensor(LOG, CFG, target, record) as s:
             s.scan_mysql()
     except Exception as x:
         record['result'] = 'EXCEPTION_ERROR'
         record['message'] = str(x)
-    THIS_RUN[url] = record
+    with LOCK:
+        THIS_RUN[url] = record
+    __publish(url, record)
 
 
-def __check_ssh_ps(cfg_name):
+def __check_ssh_ps(target):
     global LOG, CFG, DATA, THIS_RUN
-    url = CFG['urls'][cfg_name]
+    url = target.url
     LOG.info("Checking url: " + url)
     record = dict()
     record['time'] = datetime.datetime.now()
     try:
-        with PmonSensor(LOG, CFG, cfg_name, record) as s:
+        with PmonSensor(LOG, CFG, target, record) as s:
             s.scan_mysql()
     except Exception as x:
         record['result'] = 'EXCEPTION_ERROR'
         record['message'] = str(x)
-    THIS_RUN[url] = record
+    with LOCK:
+        THIS_RUN[url] = record
+    __publish(url, record)
+
 
 
+def add_listener(listener):
+    """
+    Register a callable informed about every finished check.
+    :param listener: callable(url, record), called in the thread of the check
+    :return: None
+    """
+    LISTENERS.append(listener)
+
+
+def remove_listener(listener):
+    """
+    :param listener: a callable registered with add_listener()
+    :return: None
+    """
+    if listener in LISTENERS:
+        LISTENERS.remove(listener)
+
+
+def add_history_listener(listener):
+    """
+    Register a callable informed about the checks kept in the history,
+    unlike add_listener() the checks of SSH targets are left out.
+    :param listener: callable(url, record), called in the thread of the check
+    :return: None
+    """
+    HISTORY_LISTENERS.append(listener)
+
+
+def __publish(url, record, persisted=False):
+    global LOG
+    listeners = list(LISTENERS)
+    if persisted:
+        listeners.extend(HISTORY_LISTENERS)
+    for listener in listeners:
+        try:
+            listener(url, record)
+        except Exception as x:
+            LOG.error('Listener failed: {0}'.format(str(x)))
+
 
 def check_url(cfg_name):
     """
@@ -162,14 +392,48 @@ def check_url(cfg_name):
     :param cfg_name: name-part in config to read URL etc from
     :return:
     """
-    global LOG, CFG, DATA, THIS_RUN
-    url = CFG['urls'][cfg_name]
-    if url.startswith('http'):
-        __http_scan(cfg_name)
-    elif url.startswith('mysql'):
-        __check_ssh_mysql(cfg_name)
-    elif url.startswith('ssh'):
-        __check_ssh_ps(cfg_name)
+    global LOG, TARGETS
+    target = TARGETS.get(cfg_name)
+    if target is None:
+        LOG.warning('No such target: ' + cfg_name)
+        return
+    __check(target)
+
+
+def __check(target):
+    if target.protocol == 'http':
+        __http_scan(target)
+    elif target.protocol == 'mysql':
+        __check_ssh_mysql(target)
+    elif target.protocol == 'ssh':
+        __check_ssh_ps(target)
+
+
+def __timed_check(target):
+    global RUN_STATS
+    start = time.monotonic()
+    try:
+        __check(target)
+    finally:
+        RUN_STATS.add_check(target.url, time.monotonic() - start)
+
+
+def __write_run_summary():
+    """
+    Log the summary of the finished run and add it to the history,
+    the next run is measured from now on.
+    :return: None
+    """
+    global LOG, CFG, HISTORY, RUN_STATS
+    stats, RUN_STATS = RUN_STATS, PmonRunStats()
+    if not CFG['pmon'].getboolean('run.summary', fallback=True):
+        return
+    summary = stats.summary(CFG['pmon']['id'])
+    LOG.info('Run summary: ' + json.dumps(summary, sort_keys=True))
+    try:
+        HISTORY.append_run(summary)
+    except Exception as x:
+        LOG.error(str(x))
 
 
 def __save_data():
@@ -177,33 +441,35 @@ def __save_data():
     Write to result file
     :return:
     """
-    global LOG, CFG, DATA, THIS_RUN
-    LOG.info('Appending result data to collective file')
-    if len(DATA) > 0:
-        try:
-            with open(CFG['pmon']['data.file'], 'w') as f:
-                f.write(json.dumps(DATA, indent=2, sort_keys=True, default=__datetime_converter))
-        except Exception as x:
-            LOG.error(str(x))
-
-    LOG.info('Writing latest')
-    if len(THIS_RUN) > 0:
-        try:
-            with open(CFG['pmon']['latest.file'], 'w') as f:
-                f.write(json.dumps(THIS_RUN, indent=2, sort_keys=True, default=__datetime_converter))
-        except Exception as x:
-            LOG.error(str(x))
-
-
-def __prepare_text_mail():
+    global LOG, CFG, THIS_RUN, HISTORY, NEW_RECORDS
+    LOG.info('Appending result data to history')
+    with LOCK:
+        if len(NEW_RECORDS) > 0:
+            try:
+                HISTORY.append(NEW_RECORDS)
+                NEW_RECORDS = list()
+            except Exception as x:
+                LOG.error(str(x))
+
+        LOG.info('Writing latest')
+        if len(THIS_RUN) > 0:
+            try:
+                with open(CFG['pmon']['latest.file'], 'w') as f:
+                    f.write(json.dumps(THIS_RUN, indent=2, sort_keys=True, default=__datetime_converter))
+            except Exception as x:
+                LOG.error(str(x))
+
+
+def __prepare_text_mail(records):
     """
+    :param records: dict of url to record to report
     :return: a MimeText with the data als plain text
     """
-    global LOG, CFG, THIS_RUN
+    global LOG, CFG
     LOG.debug("prepare text message")
     text_msg = list()
     text_data_template = Template("$result, $time, $message")
-    for url, details in THIS_RUN.items():
+    for url, details in records.items():
         line = url + " | " + text_data_template.substitute(details)
         text_msg.append(line)
 
@@ -211,11 +477,12 @@ def __prepare_text_mail():
     return MIMEText(text_out_msg, 'plain')
 
 
-def __prepare_html_mail():
+def __prepare_html_mail(records):
     """
+    :param records: dict of url to record to report
     :return: the status as HTML message
     """
-    global LOG, CFG, THIS_RUN
+    global LOG, CFG
     LOG.debug("prepare html message")
     html_data_line = Template('<tr><td><a href="$url" target="_blank">$url</a></td>$details</tr>')
     html_data_template_ok = Template(
@@ -224,7 +491,7 @@ def __prepare_html_mail():
         '<td style="text-align: center; color: #FF0000; font-weight: bold;">$result</td><td>$time</td><td>$message</td>')
 
     html_lines = list()
-    for url, details in THIS_RUN.items():
+    for url, details in records.items():
         if details['result'] == 'SUCCESS':
             html_details = html_data_template_ok.substitute(details)
         else:
@@ -279,61 +546,332 @@ def __prepare_html_mail():
     return MIMEText(html_outer, 'html')
 
 
-def __prepare_message_parts():
+def __prepare_message_parts(records, subject):
     """
+    :param records: dict of url to record to report
+    :param subject: subject of the mail
     :return: a combined MIME multipart message
     """
-    global LOG, CFG, THIS_RUN
+    global LOG, CFG, RUN_STATS
     LOG.debug("prepare multipart mail message")
-    mail_msg = MIMEMultipart('alternative')
-    mail_msg['Subject'] = 'Monitored processes on {}'.format(CFG['pmon']['id'])
-    mail_msg['From'] = CFG.get('email', 'from')
-    mail_msg['To'] = CFG.get('email', 'to')
-    # Last entry ist the preferred one to display
-    mail_msg.attach(__prepare_text_mail())
-    mail_msg.attach(__prepare_html_mail())
+    with RUN_STATS.phase('mail'):
+        mail_msg = MIMEMultipart('alternative')
+        mail_msg['Subject'] = subject
+        mail_msg['From'] = CFG.get('email', 'from')
+        mail_msg['To'] = CFG.get('email', 'to')
+        # Last entry ist the preferred one to display
+        mail_msg.attach(__prepare_text_mail(records))
+        mail_msg.attach(__prepare_html_mail(records))
     return mail_msg
 
 
+def __send_mail(records, subject):
+    """
+    :param records: dict of url to record to report
+    :param subject: subject of the mail
+    :return: True if the mail has been sent
+    """
+    global CFG, MAILER
+    msg = __prepare_message_parts(records, subject)
+    return MAILER.send(CFG.get('email', 'from'), CFG.get('email', 'to').split(','), msg)
+
+
+def __is_up(record):
+    # records of the SSH sensors carry a result only on failure
+    return record.get('result', 'SUCCESS') == 'SUCCESS'
+
+
+def __mail_state_file():
+    global CFG
+    return CFG.get('email', 'state.file',
+                   fallback=os.path.splitext(CFG['pmon']['data.file'])[0] + '.mailstate.json')
+
+
+def __load_mail_state():
+    """
+    The state of the last notification, taken from the latest
+    results on the first run.
+    :return: dict with 'states' of url -> up and the time of the last 'digest'
+    """
+    global LOG, CFG
+    try:
+        with open(__mail_state_file(), 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        pass
+    except Exception as x:
+        LOG.error(str(x))
+    states = dict()
+    try:
+        with open(CFG['pmon']['latest.file'], 'r') as f:
+            states = {url: __is_up(record) for url, record in json.load(f).items()}
+    except Exception:
+        pass
+    return {'states': states, 'digest': None}
+
+
 def notify():
     """
-    Send email notifications to configured users.
+    Send email notifications to configured users. With the email
+    mode 'changes' only changes of state are reported.
     """
     global LOG, CFG, THIS_RUN
+    if CFG.get('email', 'mode', fallback='always') == 'changes':
+        notify_changes()
+        return
     LOG.info('Notifying user(s)')
+    with LOCK:
+        records = dict(THIS_RUN)
+    __send_mail(records, 'Monitored processes on {}'.format(CFG['pmon']['id']))
 
-    # msg_text = json.dumps(THIS_RUN, indent=2, sort_keys=True, default=__datetime_converter)
-    msg = __prepare_message_parts()  # MIMEText(msg_text)
 
-    s = smtplib.SMTP(CFG.get('email', 'server'), int(CFG.get('email', 'port')))
-    LOG.debug("Mail server connected")
+def notify_changes():
+    """
+    Mail the targets that went down or up since the last notification,
+    and the complete results if the digest is due.
+    :return: None
+    """
+    global LOG, CFG, THIS_RUN, MAIL_STATE
+    states = MAIL_STATE['states']
+    with LOCK:
+        records = dict(THIS_RUN)
+
+    # targets seen the first time are reported if they are down
+    changed = {url: record for url, record in records.items()
+               if __is_up(record) != states.get(url, True)}
+    if changed:
+        down = sum(1 for record in changed.values() if not __is_up(record))
+        LOG.info('Notifying user(s) about {0} changes'.format(len(changed)))
+        subject = 'Changed processes on {0}: {1} down, {2} up'.format(CFG['pmon']['id'], down, len(changed) - down)
+        if __send_mail(changed, subject):
+            states.update({url: __is_up(record) for url, record in changed.items()})
+
+    now = datetime.datetime.now()
+    digest_hours = CFG.getint('email', 'digest.hours', fallback=0)
+    if MAIL_STATE['digest'] is None:
+        MAIL_STATE['digest'] = now.__str__()
+    elif digest_hours > 0 and records and \
+            now - datetime.datetime.fromisoformat(MAIL_STATE['digest']) >= datetime.timedelta(hours=digest_hours):
+        LOG.info('Notifying user(s) with digest')
+        if __send_mail(records, 'Monitored processes on {}'.format(CFG['pmon']['id'])):
+            MAIL_STATE['digest'] = now.__str__()
+
     try:
-        # s.login(CFG.get('email', 'from'), keyring.get_password('pmon', 'email'))
-        s.login(CFG.get('email', 'from'), CFG['email']['pwd'])
-        s.sendmail(CFG.get('email', 'from'),
-                   CFG.get('email', 'to').split(','),
-                   msg.as_string())
-        LOG.debug("mail send")
+        with open(__mail_state_file(), 'w') as f:
+            json.dump(MAIL_STATE, f, sort_keys=True)
     except Exception as x:
         LOG.error(str(x))
-    finally:
-        s.quit()
 
 
-def execute_scan(nomail_flag):
+def query_history(target, since=None, until=None):
+    """
+    Read the history of one target within a time range.
+    :param target: the url or its config-key, e.g. 'url.4'
+    :param since: datetime of the range start (inclusive), None for open
+    :param until: datetime of the range end (exclusive), None for open
+    :return: list of records, oldest first
+    """
+    global TARGETS, HISTORY
+    return list(HISTORY.query(TARGETS.resolve(target), since, until))
+
+
+def compact():
+    """
+    Apply the configured retention tiers to the history.
+    :return: None
+    """
+    global LOG, HISTORY, RETENTION
+    if RETENTION.enabled():
+        try:
+            HISTORY.compact(RETENTION)
+        except Exception as x:
+            LOG.error('Compaction failed: ' + str(x))
+
+
+def __async_http_checker():
+    """
+    :return: the shared asyncio HTTP checker, created on first use
+    """
+    global LOG, CFG, ASYNC_HTTP, ASYNC_LOCK
+    with ASYNC_LOCK:
+        if ASYNC_HTTP is None:
+            ASYNC_HTTP = PmonAsyncHttp(LOG,
+                                       int(CFG['pmon']['timeout']),
+                                       HTTP_ACCEPTED,
+                                       CFG['pmon'].getint('http.pool.size', fallback=100),
+                                       CFG['pmon'].getint('http.pool.host', fallback=10)).start()
+        return ASYNC_HTTP
+
+
+def __http_sensors(target, record):
+    global LOG, CFG
+    PmonSensor.all_sensors(LOG, CFG, target, record)
+
+
+def evict_ssh():
+    """
+    Close the SSH connections of the sensors unused for longer than 'ssh.pool.idle'.
+    :return: None
+    """
+    pool = PmonSensor.pool
+    if pool is not None:
+        pool.evict_idle()
+
+
+def evict_ssh_interval():
+    """
+    :return: seconds between two calls of evict_ssh(), 0 if SSH connections are not pooled
+    """
+    pool = PmonSensor.pool
+    return min(SSH_EVICT_INTERVAL, pool.idle_timeout) if pool is not None else 0
+
+
+def close():
+    """
+    Release resources kept between runs.
+    :return: None
+    """
+    global ASYNC_HTTP, ASYNC_LOCK, HISTORY, MAILER
+    with ASYNC_LOCK:
+        if ASYNC_HTTP is not None:
+            ASYNC_HTTP.close()
+            ASYNC_HTTP = None
+    if HISTORY is not None:
+        HISTORY.close()
+    if PmonSensor.pool is not None:
+        PmonSensor.pool.close()
+        PmonSensor.pool = None
+    if MAILER is not None:
+        MAILER.close()
+
+
+def execute_scan(nomail_flag, progress=None):
     """
     Does the main work of working through the URL-list.
+    Scans of the same process never overlap.
     :param nomail_flag: value of the flag
+    :param progress: optional callable(done, total) invoked after each check
     :return: None
     """
-    global LOG, CFG, THIS_RUN
-    LOG.debug('scan ... ')
+    global LOG, CFG, TARGETS, THIS_RUN, METRICS, RUN_STATS
+    with SCAN_LOCK:
+        LOG.debug('scan ... ')
+        scan_start = time.monotonic()
+
+        scanner = PmonScanner(LOG,
+                              CFG['pmon'].getint('scan.workers', fallback=8),
+                              CFG['pmon'].getint('scan.workers.host', fallback=2))
+        # the whole scan works on the targets of its start
+        compiled = TARGETS
+        targets = [(t.key, t.url) for t in compiled]
+        total = len(targets)
+        done = [0]
+        done_lock = threading.Lock()
+
+        def __check_done(cfg_name):
+            with done_lock:
+                done[0] += 1
+                count = done[0]
+            if progress is not None:
+                progress(count, total)
+
+        def __store_async(cfg_name, record):
+            target = compiled.get(cfg_name)
+            __store_http_record(target, record)
+            RUN_STATS.add_check(target.url, record.get('duration', 0.0))
+            __check_done(cfg_name)
+
+        def __async_sensors(cfg_name, record):
+            __http_sensors(compiled.get(cfg_name), record)
+
+        http_run = None
+        if CFG['pmon'].get('http.mode', fallback='sync') == 'async':
+            http_targets = [(t.key, t.url) for t in compiled if t.protocol == 'http']
+            targets = [(t.key, t.url) for t in compiled if t.protocol != 'http']
+            http_run = __async_http_checker().submit(http_targets, __store_async, __async_sensors)
+        scanner.scan(targets, lambda cfg_name: __timed_check(compiled.get(cfg_name)), __check_done)
+        if http_run is not None:
+            http_run.result()
+        scan_seconds = time.monotonic() - scan_start
+        METRICS.scan_done(scan_seconds)
+        RUN_STATS.add_phase('checks', scan_seconds)
+
+        # 3. post process results
+        with RUN_STATS.phase('save'):
+            __save_data()
+        with RUN_STATS.phase('compact'):
+            compact()
+        if not nomail_flag:
+            with RUN_STATS.phase('notify'):
+                notify()
+        __write_run_summary()
+
+
+def check_target(cfg_name):
+    """
+    Check a single target, HTTP urls go through the shared asyncio
+    checker in async mode.
+    :param cfg_name: name-part in config to read URL etc from
+    :return: True if the check succeeded
+    """
+    global CFG, TARGETS, THIS_RUN
+    target = TARGETS.get(cfg_name)
+    if target is None:
+        # removed by a reload while due
+        return False
+    if target.protocol == 'http' and CFG['pmon'].get('http.mode', fallback='sync') == 'async':
+        __async_http_checker().submit([(cfg_name, target.url)],
+                                      lambda n, record: __store_http_record(target, record),
+                                      lambda n, record: __http_sensors(target, record)).result()
+    else:
+        __check(target)
+    with LOCK:
+        record = THIS_RUN.get(target.url)
+    return record is not None and __is_up(record)
+
+
+def run_daemon(nomail_flag=False):
+    """
+    Check the targets continuously until stop_daemon() is called.
+    Every target is checked at its own interval from the section
+    'schedule', the results are saved periodically. Changes of
+    state are mailed periodically over a kept SMTP connection.
+    :param nomail_flag: no notification mails if True
+    :return: None
+    """
+    global LOG, CFG, TARGETS, SCHEDULER, METRICS, MAILER
+    SCHEDULER = PmonScheduler(LOG,
+                              CFG['pmon'].getint('scan.workers', fallback=8),
+                              CFG['pmon'].getint('scan.workers.host', fallback=2))
+    METRICS.queue_depth = SCHEDULER.queue_depth
+    for target in TARGETS:
+        SCHEDULER.add_check(target.key, target.url, target.interval, target.jitter, check_target)
+    SCHEDULER.adaptive(CFG.getint('schedule', 'confirm.interval', fallback=30),
+                       CFG.getint('schedule', 'confirm.count', fallback=2),
+                       CFG.getint('schedule', 'backoff.max', fallback=3600))
+    SCHEDULER.add_task('save', CFG.getint('schedule', 'save.interval', fallback=10), __save_data)
+    SCHEDULER.add_task('compact', CFG.getint('schedule', 'compact.interval', fallback=3600), compact)
+    if not nomail_flag and MAILER is not None:
+        MAILER.keep_open = True
+        SCHEDULER.add_task('notify', CFG.getint('schedule', 'notify.interval', fallback=60), notify_changes)
+    reload_interval = CFG['pmon'].getint('reload.interval', fallback=10)
+    if reload_interval > 0:
+        SCHEDULER.add_task('reload', reload_interval, reload_if_changed)
+    if evict_ssh_interval() > 0:
+        SCHEDULER.add_task('ssh.evict', evict_ssh_interval(), evict_ssh)
+    LOG.info('Daemon started')
+    try:
+        SCHEDULER.run()
+    finally:
+        __save_data()
+        LOG.info('Daemon stopped')
 
-    for n in CFG['urls'].keys():
-        if n.startswith('url.'):
-            check_url(n)
 
-    # 3. post process results
-    __save_data()
-    if not nomail_flag:
-        notify()
+def stop_daemon():
+    """
+    Stop the daemon, running checks are finished and saved.
+    :return: None
+    """
+    global SCHEDULER
+    if SCHEDULER is not None:
+        SCHEDULER.stop()
@@ -6,11 +6,17 @@
 
 import argparse
 import os
+import signal
 import sys
+import threading
 
 import cherrypy
+from cherrypy.process.plugins import Monitor
 
 import pmon
+from pmon.columnar import PmonColumnarHistory
+from pmon.events import PmonEvents
+from pmon.run_stats import PmonProfiler
 from pmon.srvr import PmonServer
 from pmon.zmq_responder import ZmqResponder
 
@@ -29,17 +35,33 @@ if __name__ == '__main__':
                         type=bool,
                         default=False,
                         help="Send no mail if set")
+    parser.add_argument('--daemon',
+                        type=bool,
+                        default=False,
+                        help="Check continuously with the internal scheduler. Combines with --server.")
     parser.add_argument('--responder',
                         type=bool,
                         default=False,
                         help='Start the 0MQ based responder. Exclusive parameter.')
+    parser.add_argument('--profile',
+                        type=str,
+                        default=None,
+                        help="Write a cProfile of the complete run to this file")
     args = parser.parse_args()
 
+    profiler = PmonProfiler(args.profile).start() if args.profile else None
     pmon.init(args.conf)
 
+    def reload_config(*ignored):
+        # not in the signal handler, the interrupted thread may hold locks
+        threading.Thread(target=pmon.reload, name='pmon-reload').start()
+
     if args.server and args.responder:
         pmon.LOG.error("Whether server OR responder is allowed")
         sys.exit(1)
+    if args.daemon and args.responder:
+        pmon.LOG.error("Whether daemon OR responder is allowed")
+        sys.exit(1)
     
     if args.server:
         #
@@ -56,16 +78,73 @@ if __name__ == '__main__':
                              'tools.staticdir.dir': pmon.CFG['pmon']['http.static']
                            }
                }
-        cherrypy.quickstart(PmonServer(pmon.LOG, pmon.CFG, args.nomail, pmon.execute_scan), '/', conf)
+        # push every finished check to the connected UIs, end their
+        # streams before the server waits for its threads
+        events = PmonEvents(pmon.LOG, pmon.CFG['pmon'].getint('http.events.max', fallback=5))
+        pmon.add_listener(events.publish)
+        cherrypy.engine.subscribe('stop', events.close, priority=10)
+        # answer '/history' from memory, kept current by the checks of
+        # the daemon; checks of other processes, e.g. cron, are only
+        # seen in the history files
+        history = pmon.HISTORY
+        if pmon.CFG['pmon'].getboolean('http.history.memory', fallback=args.daemon):
+            history = PmonColumnarHistory(pmon.RETENTION)
+            pmon.LOG.info('Loaded {0} records of the history into memory'.format(history.load(pmon.HISTORY.read())))
+            pmon.add_history_listener(history.add)
+        if args.daemon:
+            # the checks run beside the server and stop with it
+            daemon = threading.Thread(target=pmon.run_daemon, args=(args.nomail,), name='pmon-daemon')
+            cherrypy.engine.subscribe('start', daemon.start)
+            cherrypy.engine.subscribe('stop', pmon.stop_daemon)
+        else:
+            # the daemon watches the config file itself
+            reload_interval = pmon.CFG['pmon'].getint('reload.interval', fallback=10)
+            if reload_interval > 0:
+                Monitor(cherrypy.engine, pmon.reload_if_changed, reload_interval, 'pmon-reload').subscribe()
+            # the sensors of forced scans pool their SSH connections
+            if pmon.evict_ssh_interval() > 0:
+                Monitor(cherrypy.engine, pmon.evict_ssh, pmon.evict_ssh_interval(), 'pmon-ssh-evict').subscribe()
+        # SIGHUP reloads the configuration instead of restarting
+        cherrypy.engine.signal_handler.handlers['SIGHUP'] = reload_config
+        server = PmonServer(pmon.LOG,
+                            pmon.CFG,
+                            args.nomail,
+                            pmon.execute_scan,
+                            history,
+                            events,
+                            pmon.METRICS)
+        pmon.add_reload_listener(server.configure)
+        cherrypy.quickstart(server, '/', conf)
+        if args.daemon and daemon.is_alive():
+            daemon.join()
+        pmon.close()
     elif args.responder:
         #
         # Launching the ZMQ responder
         #
         with ZmqResponder() as responder:
             responder.respond()
+    elif args.daemon:
+        #
+        # Checking continuously until terminated
+        #
+        signal.signal(signal.SIGTERM, lambda signum, frame: pmon.stop_daemon())
+        signal.signal(signal.SIGINT, lambda signum, frame: pmon.stop_daemon())
+        if hasattr(signal, 'SIGHUP'):
+            signal.signal(signal.SIGHUP, reload_config)
+        try:
+            pmon.run_daemon(args.nomail)
+        finally:
+            pmon.close()
     else:
         # Process the checks
-        pmon.execute_scan(args.nomail)
+        try:
+            pmon.execute_scan(args.nomail)
+        finally:
+            pmon.close()
         pmon.LOG.info("done.")
 
+    if profiler is not None:
+        profiler.stop()
+        pmon.LOG.info("Profile written to " + args.profile)
     sys.exit(0)
@@ -0,0 +1,218 @@
+#
+# -*- coding: utf-8-*-
+# asyncio based HTTP checks on top of aiohttp.
+#
+# (c) ISC Clemenz & Weinbrecht GmbH 2018
+#
+
+import asyncio
+import datetime
+import threading
+import time
+import urllib.parse
+
+try:
+    import aiohttp
+except ImportError:
+    # optional, only required for http.mode=async
+    aiohttp = None
+
+
+class PmonAsyncHttp(object):
+    """
+    HTTP checker running on an asyncio event loop in a background
+    thread. All checks share one aiohttp session, so keep-alive
+    connections are pooled across targets and, as long as the
+    checker lives, across runs. The pool is bounded in total and
+    per host. A check waits for a free slot before its clock and its
+    timeout start, so waiting for the pool is no failure of the target.
+    Cleanup requires call to 'close()'
+    """
+    log = None
+    timeout = 5
+    accepted = None
+    limit = 100
+    limit_per_host = 10
+    loop = None
+    session = None
+    thread = None
+    slots = None
+    host_slots = None
+    lock = None
+
+    def __init__(self, log, timeout, accepted, limit, limit_per_host):
+        """
+        Constructor.
+        :param log: the logger
+        :param timeout: timeout of a single check in seconds
+        :param accepted: collection of HTTP status codes counting as success
+        :param limit: maximum number of pooled connections
+        :param limit_per_host: maximum number of pooled connections per host
+        """
+        if aiohttp is None:
+            raise Exception('http.mode=async requires the aiohttp module')
+        self.log = log
+        self.timeout = timeout
+        self.accepted = frozenset(accepted)
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        # serializes start() and close() called from several threads
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def __run_loop(loop):
+        asyncio.set_event_loop(loop)
+        loop.run_forever()
+
+    @staticmethod
+    def _trace_config():
+        """
+        Measure the phases of a request, the timing dict of the
+        check is passed as trace_request_ctx. aiohttp reports the
+        TLS handshake as part of the connect.
+        """
+        def mark(name):
+            async def on_event(session, context, params):
+                context.trace_request_ctx[name] = time.monotonic()
+            return on_event
+
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_dns_resolvehost_start.append(mark('dns_start'))
+        trace_config.on_dns_resolvehost_end.append(mark('dns_end'))
+        trace_config.on_connection_create_start.append(mark('connect_start'))
+        trace_config.on_connection_create_end.append(mark('connect_end'))
+        trace_config.on_request_headers_sent.append(mark('sent'))
+        trace_config.on_request_end.append(mark('received'))
+        return trace_config
+
+    @staticmethod
+    def _timing(marks):
+        """
+        :param marks: monotonic times of the traced events
+        :return: seconds of the phases like recorded by the sync checks
+        """
+        timing = dict()
+        if 'dns_end' in marks and 'dns_start' in marks:
+            timing['dns'] = marks['dns_end'] - marks['dns_start']
+        if 'connect_end' in marks and 'connect_start' in marks:
+            timing['connect'] = marks['connect_end'] - marks['connect_start'] - timing.get('dns', 0.0)
+        if 'received' in marks and 'sent' in marks:
+            timing['ttfb'] = marks['received'] - marks['sent']
+        return {k: round(v, 6) for k, v in timing.items()}
+
+    async def __open_session(self):
+        connector = aiohttp.TCPConnector(limit=self.limit,
+                                         limit_per_host=self.limit_per_host,
+                                         ttl_dns_cache=300)
+        self.session = aiohttp.ClientSession(connector=connector,
+                                             timeout=aiohttp.ClientTimeout(total=self.timeout),
+                                             trace_configs=[self._trace_config()])
+        # the same bounds like the connector, but taken before the timeout starts
+        self.slots = asyncio.Semaphore(self.limit)
+        self.host_slots = dict()
+
+    def __host_slots(self, url):
+        parsed = urllib.parse.urlsplit(url)
+        key = (parsed.scheme, parsed.hostname, parsed.port)
+        slots = self.host_slots.get(key)
+        if slots is None:
+            slots = asyncio.Semaphore(self.limit_per_host)
+            self.host_slots[key] = slots
+        return slots
+
+    def start(self):
+        """
+        Start the event loop thread and open the shared session.
+        The loop is published only once the session is open.
+        :return: self
+        """
+        with self.lock:
+            if self.loop is not None:
+                return self
+            loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=self.__run_loop,
+                                      args=(loop,),
+                                      name='pmon-async-http',
+                                      daemon=True)
+            thread.start()
+            asyncio.run_coroutine_threadsafe(self.__open_session(), loop).result()
+            self.thread = thread
+            self.loop = loop
+        self.log.debug('Async HTTP checker started')
+        return self
+
+    def close(self):
+        """
+        Close the session with all pooled connections and stop the loop.
+        :return: None
+        """
+        with self.lock:
+            if self.loop is None:
+                return
+            if self.session is not None:
+                asyncio.run_coroutine_threadsafe(self.session.close(), self.loop).result()
+                self.session = None
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+            self.loop.close()
+            self.loop = None
+            self.thread = None
+        self.log.debug('Async HTTP checker closed')
+
+    async def __check(self, cfg_name, url, store, on_failure):
+        try:
+            host_slots = self.__host_slots(url)
+        except ValueError:
+            host_slots = self.slots
+        async with host_slots, self.slots:
+            record = await self.__get(url)
+        if record.get('result') != 'SUCCESS' and on_failure is not None:
+            # the sensors are blocking, keep them off the loop
+            await self.loop.run_in_executor(None, on_failure, cfg_name, record)
+        store(cfg_name, record)
+
+    async def __get(self, url):
+        self.log.info("Checking url: " + url)
+        record = dict()
+        marks = dict()
+        start = time.monotonic()
+        try:
+            record['time'] = datetime.datetime.now()
+            async with self.session.get(url, trace_request_ctx=marks) as rsp:
+                # drain the body, so the connection goes back to the pool
+                body = await rsp.read()
+                record['duration'] = round(time.monotonic() - start, 6)
+                record['timing'] = self._timing(marks)
+                record['size'] = len(body)
+                if rsp.status in self.accepted:
+                    self.log.info("Check succeeded")
+                    record['result'] = 'SUCCESS'
+                    record['message'] = 'OK'
+                else:
+                    self.log.warning("Check failed with status: " + str(rsp.status))
+                    record['result'] = 'APPLICATION_ERROR'
+                    record['message'] = rsp.status
+        except Exception as x:
+            record['duration'] = round(time.monotonic() - start, 6)
+            record['timing'] = self._timing(marks)
+            message = str(x) if str(x) else x.__class__.__name__
+            self.log.error("Check failed due: " + message)
+            record['result'] = 'EXCEPTION_ERROR'
+            record['message'] = message
+        return record
+
+    async def __check_all(self, targets, store, on_failure):
+        await asyncio.gather(*[self.__check(cfg_name, url, store, on_failure)
+                               for cfg_name, url in targets])
+
+    def submit(self, targets, store, on_failure=None):
+        """
+        Schedule the checks of the given targets on the event loop.
+        :param targets: list of (config-key, url) pairs
+        :param store: callable(config-key, record) invoked for every finished check
+        :param on_failure: optional callable(config-key, record) invoked for failed checks
+        :return: a concurrent.futures.Future done when all checks are finished
+        """
+        self.start()
+        return asyncio.run_coroutine_threadsafe(self.__check_all(targets, store, on_failure),
+                                                self.loop)
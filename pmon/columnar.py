@@ -0,0 +1,382 @@
+#
+# -*- coding: utf-8-*-
+# Compact in-memory result history, one set of columns per target.
+#
+# (c) ISC Clemenz & Weinbrecht GmbH 2018
+#
+
+import array
+import bisect
+import datetime
+import heapq
+import json
+import threading
+
+from pmon.retention import PmonRetention
+
+EPOCH = datetime.datetime(1970, 1, 1)
+# phases of the 'timing' of HTTP checks with a column each
+PHASES = ('dns', 'connect', 'tls', 'ttfb')
+# a record field is a column, all other fields are kept as JSON
+COLUMNS = ('time', 'result', 'message', 'duration', 'size', 'timing')
+INT_MAX = 2 ** 31 - 1
+
+
+def _to_micros(value):
+    """
+    :param value: datetime or time string of a record
+    :return: microseconds since 1970-01-01 in local time, None if not parsable
+    """
+    time = PmonRetention.parse_time(value)
+    if time is None:
+        return None
+    if time.tzinfo is not None:
+        time = time.astimezone().replace(tzinfo=None)
+    delta = time - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def _from_micros(micros):
+    return (EPOCH + datetime.timedelta(microseconds=micros)).__str__()
+
+
+def _seconds_to_micros(value):
+    """
+    :param value: seconds of a duration
+    :return: the duration in microseconds, None if it is no number or out of range
+    """
+    if not isinstance(value, (int, float)) or isinstance(value, bool):
+        return None
+    micros = round(value * 1000000)
+    return micros if 0 <= micros <= INT_MAX else None
+
+
+class _Interned(object):
+    """
+    Table of distinct values, a column holds their numbers only.
+    Number 0 stands for a missing value. The rows using a value are
+    counted, the number of a value no longer used is reused.
+    """
+    __slots__ = ('values', 'numbers', 'counts', 'free', 'limit')
+
+    def __init__(self, limit):
+        self.values = [None]
+        self.numbers = dict()
+        self.counts = [0]
+        self.free = list()
+        self.limit = limit
+
+    def number(self, value):
+        """
+        :return: the number of the value, None if the table is full
+        """
+        key = (type(value), value)
+        number = self.numbers.get(key)
+        if number is None:
+            if self.free:
+                number = self.free.pop()
+                self.values[number] = value
+            elif len(self.values) < self.limit:
+                number = len(self.values)
+                self.values.append(value)
+                self.counts.append(0)
+            else:
+                return None
+            self.numbers[key] = number
+        self.counts[number] += 1
+        return number
+
+    def release(self, numbers):
+        """
+        :param numbers: numbers of dropped rows, 0 is ignored
+        """
+        for number in numbers:
+            if number == 0:
+                continue
+            self.counts[number] -= 1
+            if self.counts[number] == 0:
+                value = self.values[number]
+                del self.numbers[(type(value), value)]
+                self.values[number] = None
+                self.free.append(number)
+
+
+class _Columns(object):
+    """
+    The records of one target, sorted by time. Durations are kept
+    in microseconds, -1 stands for a missing value.
+    """
+    __slots__ = ('times', 'seqs', 'results', 'messages', 'durations', 'sizes', 'timings', 'extras')
+
+    def __init__(self):
+        self.times = array.array('q')
+        self.seqs = array.array('q')
+        self.results = array.array('B')
+        self.messages = array.array('I')
+        self.durations = array.array('i')
+        self.sizes = array.array('i')
+        self.timings = tuple(array.array('i') for _ in PHASES)
+        # seq -> JSON of the fields without a column
+        self.extras = dict()
+
+    def columns(self):
+        return (self.times, self.seqs, self.results, self.messages, self.durations, self.sizes) + self.timings
+
+    def __len__(self):
+        return len(self.times)
+
+
+class PmonColumnarHistory(object):
+    """
+    Result history held in memory for the server. Each target keeps
+    its records as parallel arrays: time in microseconds, numbers of
+    the interned result and message, duration, size and the phases
+    of HTTP checks. A record takes some 40 bytes instead of several
+    hundred as dictionary, so millions of records fit in memory.
+    Records are converted from and to the JSON shape of the history
+    only when added and when queried.
+
+    Offers find() like PmonHistory, the records are usable as
+    history of the '/history' resource and as check listener.
+    """
+    lock = None
+    targets = None
+    results = None
+    messages = None
+    seq = 0
+    retention = None
+    trimmed = None
+    count = 0
+
+    def __init__(self, retention=None):
+        """
+        Constructor.
+        :param retention: optional PmonRetention, raw records it rolls up are dropped
+        """
+        self.lock = threading.Lock()
+        self.targets = dict()
+        self.results = _Interned(256)
+        self.messages = _Interned(2 ** 24)
+        self.retention = retention
+        self.trimmed = None
+
+    def __len__(self):
+        return self.count
+
+    def _encode(self, record):
+        """
+        :param record: a check record
+        :return: (time, result, message, duration, size, timings, extra fields)
+        """
+        extras = {k: v for k, v in record.items() if k not in COLUMNS}
+        time = _to_micros(record.get('time'))
+        if time is None:
+            time = 0
+            if 'time' in record:
+                extras['time'] = str(record['time'])
+        elif PmonRetention.parse_time(record['time']).tzinfo is not None:
+            # sorted by local time, returned with its offset
+            extras['time'] = str(record['time'])
+        result = 0
+        if 'result' in record:
+            result = self.results.number(record['result'])
+            if result is None:
+                result = 0
+                extras['result'] = record['result']
+        message = 0
+        if 'message' in record:
+            message = self.messages.number(record['message'])
+            if message is None:
+                message = 0
+                extras['message'] = record['message']
+        duration = -1
+        if 'duration' in record:
+            duration = _seconds_to_micros(record['duration'])
+            if duration is None:
+                duration = -1
+                extras['duration'] = record['duration']
+        size = -1
+        if 'size' in record:
+            size = record['size']
+            if not isinstance(size, int) or isinstance(size, bool) or not 0 <= size <= INT_MAX:
+                extras['size'] = size
+                size = -1
+        timing = record.get('timing')
+        timings = [-1] * len(PHASES)
+        if isinstance(timing, dict):
+            for n, phase in enumerate(PHASES):
+                if phase in timing:
+                    timings[n] = _seconds_to_micros(timing[phase])
+            if None in timings or len(timing) > sum(1 for t in timings if t >= 0):
+                # phases without a column, the record keeps its timing as is
+                extras['timing'] = timing
+                timings = [-1] * len(PHASES)
+        elif timing is not None:
+            extras['timing'] = timing
+        return time, result, message, duration, size, timings, extras
+
+    def _decode(self, columns, row):
+        """
+        :return: the record in its JSON shape
+        """
+        record = dict()
+        seq = columns.seqs[row]
+        extra = columns.extras.get(seq)
+        if extra is not None:
+            record.update(json.loads(extra))
+        if 'time' not in record:
+            record['time'] = _from_micros(columns.times[row])
+        result = columns.results[row]
+        if result:
+            record['result'] = self.results.values[result]
+        message = columns.messages[row]
+        if message:
+            record['message'] = self.messages.values[message]
+        duration = columns.durations[row]
+        if duration >= 0:
+            record['duration'] = duration / 1000000
+        size = columns.sizes[row]
+        if size >= 0:
+            record['size'] = size
+        if 'timing' not in record:
+            timing = {phase: values[row] / 1000000
+                      for phase, values in zip(PHASES, columns.timings) if values[row] >= 0}
+            if timing:
+                record['timing'] = timing
+        return record
+
+    def _add(self, url, record):
+        time, result, message, duration, size, timings, extras = self._encode(record)
+        columns = self.targets.get(url)
+        if columns is None:
+            columns = _Columns()
+            self.targets[url] = columns
+        self.seq += 1
+        values = (time, self.seq, result, message, duration, size) + tuple(timings)
+        if not columns.times or columns.times[-1] <= time:
+            for column, value in zip(columns.columns(), values):
+                column.append(value)
+        else:
+            # late record, rare
+            row = bisect.bisect_right(columns.times, time)
+            for column, value in zip(columns.columns(), values):
+                column.insert(row, value)
+        if extras:
+            columns.extras[self.seq] = json.dumps(extras, sort_keys=True, default=str)
+        self.count += 1
+
+    def _trim(self):
+        """
+        Drop the records rolled up by the retention, at most hourly.
+        """
+        if self.retention is None:
+            return
+        now = datetime.datetime.now()
+        if self.trimmed is not None and now - self.trimmed < datetime.timedelta(hours=1):
+            return
+        self.trimmed = now
+        cutoff = self.retention.raw_cutoff(now)
+        if cutoff is None:
+            return
+        cutoff = _to_micros(cutoff)
+        for url, columns in list(self.targets.items()):
+            rows = bisect.bisect_left(columns.times, cutoff)
+            if rows == 0:
+                continue
+            for seq in columns.seqs[:rows]:
+                columns.extras.pop(seq, None)
+            self.messages.release(columns.messages[:rows])
+            for column in columns.columns():
+                del column[:rows]
+            self.count -= rows
+            if not columns:
+                del self.targets[url]
+
+    def add(self, url, record):
+        """
+        Add a record, usable as listener of pmon.
+        :param url: the checked url
+        :param record: result of the check
+        :return: None
+        """
+        with self.lock:
+            self._add(url, record)
+            self._trim()
+
+    def load(self, records):
+        """
+        Add records in bulk, e.g. the history read at startup.
+        :param records: iterable of (url, record) pairs
+        :return: number of added records
+        """
+        count = 0
+        chunk = list()
+        for pair in records:
+            chunk.append(pair)
+            if len(chunk) == 1000:
+                count += self._load_chunk(chunk)
+                chunk = list()
+        count += self._load_chunk(chunk)
+        with self.lock:
+            self._trim()
+        return count
+
+    def _load_chunk(self, chunk):
+        with self.lock:
+            for url, record in chunk:
+                self._add(url, record)
+        return len(chunk)
+
+    def _rows(self, columns, since, until, codes, after):
+        """
+        Matching records of one target, the lock is only held per record.
+        :return: generator of ((time, seq), record)
+        """
+        position = after
+        while True:
+            with self.lock:
+                times = columns.times
+                lower = since if position is None else max(since, position[0])
+                row = bisect.bisect_left(times, lower)
+                while row < len(times) and position is not None and \
+                        (times[row], columns.seqs[row]) <= position:
+                    row += 1
+                while row < len(times) and times[row] < until and \
+                        codes is not None and columns.results[row] not in codes:
+                    row += 1
+                if row >= len(times) or times[row] >= until:
+                    return
+                position = (times[row], columns.seqs[row])
+                record = self._decode(columns, row)
+            yield position, record
+
+    def find(self, url=None, since=None, until=None, results=None, after=None):
+        """
+        Records of all or one target within a time range, oldest first.
+        :param url: url of the target, None for all
+        :param since: datetime of the range start (inclusive), None for open
+        :param until: datetime of the range end (exclusive), None for open
+        :param results: list of result codes to select, None for all
+        :param after: position of a record, only records behind it are returned
+        :return: generator of (position, url, record), the position is [time, seq]
+        """
+        since = _to_micros(since) if since is not None else -2 ** 63
+        until = _to_micros(until) if until is not None else 2 ** 63 - 1
+        after = tuple(after) if after is not None else None
+        with self.lock:
+            if url is None:
+                targets = list(self.targets.items())
+            else:
+                targets = [(url, self.targets[url])] if url in self.targets else list()
+            codes = None
+            if results is not None:
+                codes = set(self.results.numbers[(str, r)] for r in results if (str, r) in self.results.numbers)
+        streams = [self._tagged(target, self._rows(columns, since, until, codes, after))
+                   for target, columns in targets]
+        for position, target, record in heapq.merge(*streams, key=lambda item: item[0]):
+            yield list(position), target, record
+
+    @staticmethod
+    def _tagged(url, rows):
+        for position, record in rows:
+            yield position, url, record
@@ -0,0 +1,108 @@
+#
+# -*- coding: utf-8-*-
+# Fan-out of check results to connected event stream clients.
+#
+# (c) ISC Clemenz & Weinbrecht GmbH 2018
+#
+
+import collections
+import itertools
+import json
+import queue
+import threading
+
+
+class PmonEvents(object):
+    """
+    Distributes every finished check to the subscribed clients.
+    Each subscriber has a bounded queue, a client not reading fast
+    enough loses its oldest events instead of blocking the checks.
+    The most recent events are kept, so a reconnecting client can
+    continue after the last event it has seen.
+    """
+    KEEP = 100
+    QUEUE_SIZE = 100
+
+    log = None
+    max_subscribers = 0
+    lock = None
+    subscribers = None
+    recent = None
+    ids = None
+
+    def __init__(self, log, max_subscribers):
+        """
+        Constructor.
+        :param log: the logger
+        :param max_subscribers: maximum number of clients connected at once
+        """
+        self.log = log
+        self.max_subscribers = max_subscribers
+        self.lock = threading.Lock()
+        self.subscribers = list()
+        self.recent = collections.deque(maxlen=self.KEEP)
+        self.ids = itertools.count(1)
+
+    @staticmethod
+    def _put(subscriber, event):
+        while True:
+            try:
+                subscriber.put_nowait(event)
+                return
+            except queue.Full:
+                try:
+                    subscriber.get_nowait()
+                except queue.Empty:
+                    pass
+
+    def publish(self, url, record):
+        """
+        Send the result of a check to all subscribers.
+        :param url: the checked url
+        :param record: result of the check
+        :return: None
+        """
+        data = json.dumps({'url': url, 'record': record}, sort_keys=True, default=str)
+        with self.lock:
+            event = (next(self.ids), data)
+            self.recent.append(event)
+            for subscriber in self.subscribers:
+                self._put(subscriber, event)
+
+    def subscribe(self, last_id=None):
+        """
+        Register a client.
+        :param last_id: id of the last event the client has seen, replays the newer ones
+        :return: queue of (id, data) events, None if there are too many subscribers
+        """
+        subscriber = queue.Queue(self.QUEUE_SIZE)
+        with self.lock:
+            if len(self.subscribers) >= self.max_subscribers:
+                return None
+            if last_id is not None:
+                for event in self.recent:
+                    if event[0] > last_id:
+                        self._put(subscriber, event)
+            self.subscribers.append(subscriber)
+        self.log.debug('Event subscriber added, {0} connected'.format(len(self.subscribers)))
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        """
+        :param subscriber: the queue returned by subscribe()
+        :return: None
+        """
+        with self.lock:
+            if subscriber in self.subscribers:
+                self.subscribers.remove(subscriber)
+        self.log.debug('Event subscriber removed')
+
+    def close(self):
+        """
+        End the streams of all subscribers.
+        :return: None
+        """
+        with self.lock:
+            for subscriber in self.subscribers:
+                self._put(subscriber, None)
+            self.subscribers = list()
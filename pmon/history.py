@@ -0,0 +1,538 @@
+#
+# -*- coding: utf-8-*-
+# Append-only result history in JSON Lines segments.
+#
+# (c) ISC Clemenz & Weinbrecht GmbH 2018
+#
+
+import collections.abc
+import datetime
+import json
+import os
+import re
+import threading
+
+from pmon.retention import HOUR, DAY, PmonRetention
+
+
+def read_data_file(data_file):
+    """
+    Read a former 'data.file' holding the complete history as a
+    single JSON document of url to list of records.
+    :param data_file: name of the JSON file
+    :return: list of (url, record) pairs sorted by time
+    """
+    with open(data_file, 'r') as f:
+        data = json.load(f)
+
+    records = list()
+    for url, url_lines in data.items():
+        if isinstance(url_lines, dict):
+            url_lines = [url_lines]
+        for record in url_lines:
+            records.append((url, record))
+    records.sort(key=lambda r: (str(r[1].get('time', '')), r[0]))
+    return records
+
+
+def time_key(value):
+    """
+    :param value: datetime or time string of a record
+    :return: the time as string in sortable form, '' if not parsable
+    """
+    time = PmonRetention.parse_time(value)
+    return time.isoformat(sep=' ', timespec='microseconds') if time is not None else ''
+
+
+def in_range(record, since, until):
+    """
+    :param record: a check record
+    :param since: datetime of the range start (inclusive), None for open
+    :param until: datetime of the range end (exclusive), None for open
+    :return: True if the time of the record is within the range
+    """
+    if since is None and until is None:
+        return True
+    time = PmonRetention.parse_time(record.get('time'))
+    if time is None:
+        return False
+    return (since is None or time >= since) and (until is None or time < until)
+
+
+class PmonHistory(object):
+    """
+    Result history stored as a directory of JSON Lines files. Every
+    line holds one check record together with its url. A run only
+    appends its new records to the newest segment, a new segment is
+    started when the newest one exceeds the segment size.
+
+    Next to every segment an index file holds offset, length, time,
+    url and result of its lines, so queries filter on the index and
+    decode only the matching records. The time range of each indexed
+    segment is kept in memory to skip segments outside a query.
+    """
+    SEGMENT_PATTERN = re.compile(r'^segment-(\d{8})\.jsonl$')
+    ROLLUP_FILES = {HOUR: 'rollup-hour.jsonl', DAY: 'rollup-day.jsonl'}
+    RUNS_FILE = 'runs.jsonl'
+
+    log = None
+    directory = None
+    segment_size = 0
+    lock = None
+    # segment name to (indexed bytes, first time, last time)
+    bounds = None
+
+    def __init__(self, log, directory, segment_size):
+        """
+        Constructor.
+        :param log: the logger
+        :param directory: directory holding the segments, created if missing
+        :param segment_size: size in bytes after which a new segment is started
+        """
+        self.log = log
+        self.directory = directory
+        self.segment_size = segment_size
+        self.lock = threading.Lock()
+        self.bounds = dict()
+        os.makedirs(directory, exist_ok=True)
+
+    def close(self):
+        """
+        Nothing to release, the segments are only open while in use.
+        """
+        pass
+
+    @staticmethod
+    def _datetime_converter(o):
+        """
+        Converter for JSON output
+        :param o: value to convert to a string
+        :return: string representation of the value
+        """
+        if isinstance(o, datetime.datetime):
+            return o.__str__()
+
+    @staticmethod
+    def _to_line(url, record):
+        line = dict(record)
+        line['url'] = url
+        return json.dumps(line, sort_keys=True, default=PmonHistory._datetime_converter) + '\n'
+
+    @staticmethod
+    def _from_line(line):
+        record = json.loads(line)
+        return record.pop('url'), record
+
+    def _parse(self, segment, line):
+        """
+        Decode a line, e.g. torn by a crash while appending.
+        :return: (url, record), None if the line is not a record
+        """
+        try:
+            return self._from_line(line)
+        except (ValueError, KeyError, AttributeError, TypeError):
+            self.log.warning('Skipping broken line of {0}: {1!r}'.format(segment, line[:80]))
+            return None
+
+    def _repair(self, segment, size):
+        """
+        Terminate the last line of the segment, so appended lines do
+        not continue it. A partial line is cut off, a complete record
+        just lacking the newline is kept. Call with the lock held.
+        :param segment: name of the segment
+        :param size: size of the segment
+        :return: the size after the repair
+        """
+        with open(segment, 'rb+') as f:
+            end = size
+            while end > 0:
+                start = max(0, end - 4096)
+                f.seek(start)
+                newline = f.read(end - start).rfind(b'\n')
+                if newline >= 0:
+                    end = start + newline + 1
+                    break
+                end = start
+            if end == size:
+                return size
+            f.seek(end)
+            if self._parse(segment, f.read(size - end)) is not None:
+                f.seek(size)
+                f.write(b'\n')
+                return size + 1
+            f.truncate(end)
+        self.log.warning('Removed partial last line of {0}, {1} bytes'.format(segment, size - end))
+        return end
+
+    def segments(self):
+        """
+        :return: full names of all segment files, oldest first
+        """
+        names = [n for n in os.listdir(self.directory) if self.SEGMENT_PATTERN.match(n)]
+        return [os.path.join(self.directory, n) for n in sorted(names)]
+
+    @staticmethod
+    def _index_name(segment):
+        return segment[:-len('.jsonl')] + '.idx'
+
+    def _segment_number(self, segment):
+        return int(self.SEGMENT_PATTERN.match(os.path.basename(segment)).group(1))
+
+    def _segment_name(self, number):
+        return os.path.join(self.directory, 'segment-{0:08d}.jsonl'.format(number))
+
+    def _active_segment(self):
+        """
+        :return: name of the segment to append to, rotated if the newest one is full
+        """
+        segments = self.segments()
+        if not segments:
+            return self._segment_name(1)
+        newest = segments[-1]
+        if os.path.getsize(newest) < self.segment_size:
+            return newest
+        number = self._segment_number(newest) + 1
+        self.log.info('Rotating history to segment {0}'.format(number))
+        return self._segment_name(number)
+
+    def is_empty(self):
+        """
+        :return: True if no record has been written yet
+        """
+        return all(os.path.getsize(s) == 0 for s in self.segments())
+
+    def append(self, records):
+        """
+        Append records to the history.
+        :param records: list of (url, record) pairs
+        :return: None
+        """
+        if not records:
+            return
+        with self.lock:
+            segment = self._active_segment()
+            lines = [self._to_line(url, record).encode('utf-8') for url, record in records]
+            offset = os.path.getsize(segment) if os.path.isfile(segment) else 0
+            if offset > 0:
+                offset = self._repair(segment, offset)
+            with open(segment, 'ab') as f:
+                f.write(b''.join(lines))
+            # extend the index only if it covers the segment so far,
+            # otherwise it is completed on the next query
+            bounds = self.bounds.get(segment)
+            new = offset == 0
+            if new or (bounds is not None and bounds[0] == offset):
+                entries = list()
+                for (url, record), line in zip(records, lines):
+                    entries.append([offset, len(line), time_key(record.get('time')), url, record.get('result')])
+                    offset += len(line)
+                self._write_index(segment, entries, new)
+        self.log.debug('{0} records appended to history'.format(len(records)))
+
+    def read(self):
+        """
+        Read all records, oldest first.
+        :return: generator of (url, record) pairs
+        """
+        for segment in self.segments():
+            with open(segment, 'r', errors='replace') as f:
+                for line in f:
+                    if line.strip():
+                        pair = self._parse(segment, line)
+                        if pair is not None:
+                            yield pair
+
+    def read_url(self, url):
+        """
+        Read the records of one url, oldest first. Lines of other urls
+        are skipped without decoding them.
+        :param url: the url
+        :return: generator of records
+        """
+        marker = '"url": ' + json.dumps(url)
+        for segment in self.segments():
+            with open(segment, 'r', errors='replace') as f:
+                for line in f:
+                    if marker in line:
+                        pair = self._parse(segment, line)
+                        if pair is not None and pair[0] == url:
+                            yield pair[1]
+
+    def query(self, url, since=None, until=None):
+        """
+        Read the records of one url within a time range.
+        :param url: the url
+        :param since: datetime of the range start (inclusive), None for open
+        :param until: datetime of the range end (exclusive), None for open
+        :return: generator of records, oldest first
+        """
+        for record in self.read_url(url):
+            if in_range(record, since, until):
+                yield record
+
+    def _write_index(self, segment, entries, new):
+        """
+        Append entries to the index of a segment and update its bounds.
+        :param segment: name of the segment
+        :param entries: list of [offset, length, time, url, result]
+        :param new: True if the index is started from scratch
+        """
+        with open(self._index_name(segment), 'w' if new else 'a') as f:
+            f.write(''.join(json.dumps(e) + '\n' for e in entries))
+        times = [e[2] for e in entries if e[2]]
+        end = entries[-1][0] + entries[-1][1] if entries else 0
+        first, last = (None, None) if new else self.bounds.get(segment, (0, None, None))[1:]
+        if times:
+            first = min(times + ([first] if first else []))
+            last = max(times + ([last] if last else []))
+        self.bounds[segment] = (end, first, last)
+
+    def _read_index(self, segment):
+        """
+        Read the index of a segment, lines appended without being
+        indexed are added to it first. Call with the lock held.
+        :param segment: name of the segment
+        :return: list of [offset, length, time, url, result]
+        """
+        name = self._index_name(segment)
+        entries = list()
+        if os.path.isfile(name):
+            with open(name, 'r') as f:
+                entries = [json.loads(line) for line in f if line.strip()]
+        end = entries[-1][0] + entries[-1][1] if entries else 0
+        size = os.path.getsize(segment)
+        if end > size:
+            # the segment has been rewritten
+            entries, end = list(), 0
+        added = list()
+        if end < size:
+            with open(segment, 'rb') as f:
+                f.seek(end)
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        break
+                    pair = self._parse(segment, line) if line.strip() else None
+                    if pair is not None:
+                        url, record = pair
+                        added.append([end, len(line), time_key(record.get('time')), url, record.get('result')])
+                    end += len(line)
+        if added or not os.path.isfile(name) or not entries:
+            self.bounds.pop(segment, None)
+            self._write_index(segment, entries + added, True)
+        elif segment not in self.bounds:
+            times = [e[2] for e in entries if e[2]]
+            self.bounds[segment] = (end, min(times) if times else None, max(times) if times else None)
+        return entries + added
+
+    def _outside(self, segment, since, until):
+        """
+        :return: True if the indexed time range of the segment is outside the query
+        """
+        bounds = self.bounds.get(segment)
+        if bounds is None or bounds[0] != os.path.getsize(segment) or bounds[1] is None:
+            return False
+        return (since is not None and bounds[2] < since) or (until is not None and bounds[1] >= until)
+
+    def find(self, url=None, since=None, until=None, results=None, after=None):
+        """
+        Read the records matching a query using the segment indexes,
+        in the order they have been written.
+        :param url: the url, None for all
+        :param since: datetime of the range start (inclusive), None for open
+        :param until: datetime of the range end (exclusive), None for open
+        :param results: collection of result codes, None for all
+        :param after: position returned with a previous record to continue after it
+        :return: generator of (position, url, record)
+        """
+        since = time_key(since) if since is not None else None
+        until = time_key(until) if until is not None else None
+        start_segment, start_offset = after if after is not None else (0, -1)
+        for segment in self.segments():
+            number = self._segment_number(segment)
+            if number < start_segment:
+                continue
+            with self.lock:
+                if self._outside(segment, since, until):
+                    continue
+                entries = self._read_index(segment)
+            positions = list()
+            for offset, length, time, line_url, result in entries:
+                if number == start_segment and offset <= start_offset:
+                    continue
+                if url is not None and line_url != url:
+                    continue
+                if results is not None and result not in results:
+                    continue
+                if (since is not None and time < since) or (until is not None and time >= until):
+                    continue
+                positions.append((offset, length))
+            if not positions:
+                continue
+            with open(segment, 'rb') as f:
+                for offset, length in positions:
+                    f.seek(offset)
+                    pair = self._parse(segment, f.read(length))
+                    if pair is not None:
+                        yield [number, offset], pair[0], pair[1]
+
+    def read_rollups(self, period):
+        """
+        :param period: HOUR or DAY
+        :return: list of the rollups of the period, oldest first
+        """
+        name = os.path.join(self.directory, self.ROLLUP_FILES[period])
+        if not os.path.isfile(name):
+            return list()
+        with open(name, 'r') as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    def append_run(self, summary):
+        """
+        Append the summary of a run to the run log.
+        :param summary: dict of the run, see PmonRunStats.summary()
+        :return: None
+        """
+        with self.lock:
+            with open(os.path.join(self.directory, self.RUNS_FILE), 'a') as f:
+                f.write(json.dumps(summary, sort_keys=True) + '\n')
+
+    def read_runs(self, limit=None):
+        """
+        :param limit: maximum number of summaries, the newest ones; None for all
+        :return: list of the run summaries, oldest first
+        """
+        name = os.path.join(self.directory, self.RUNS_FILE)
+        if not os.path.isfile(name):
+            return list()
+        with open(name, 'r') as f:
+            runs = [json.loads(line) for line in f if line.strip()]
+        return runs[-limit:] if limit else runs
+
+    @staticmethod
+    def _replace_file(name, lines):
+        """
+        Atomically replace the content of a file.
+        """
+        tmp_name = name + '.tmp'
+        with open(tmp_name, 'w') as f:
+            f.write(''.join(lines))
+        os.replace(tmp_name, name)
+
+    def _first_time(self, segment, retention):
+        with open(segment, 'r', errors='replace') as f:
+            for line in f:
+                pair = self._parse(segment, line) if line.strip() else None
+                if pair is not None:
+                    return retention.parse_time(pair[1].get('time'))
+        return None
+
+    def compact(self, retention, now=None):
+        """
+        Enforce the retention tiers. Expired raw records are removed
+        from the segments and counted into the hourly rollups, the
+        rollups are condensed and dropped according to their tiers.
+        Segments are expected in time order, compaction stops at the
+        first segment starting after the raw cutoff.
+        :param retention: the PmonRetention to apply
+        :param now: the current time, defaults to now
+        :return: number of raw records rolled up
+        """
+        if not retention.enabled():
+            return 0
+        now = now if now is not None else datetime.datetime.now()
+        cutoff = retention.raw_cutoff(now)
+        rolled = 0
+        with self.lock:
+            hourly = self.read_rollups(HOUR)
+            daily = self.read_rollups(DAY)
+            rewrites = list()
+            for segment in self.segments():
+                first = self._first_time(segment, retention)
+                if first is not None and first >= cutoff:
+                    break
+                kept = list()
+                expired = list()
+                with open(segment, 'r', errors='replace') as f:
+                    for line in f:
+                        pair = self._parse(segment, line) if line.strip() else None
+                        if pair is None:
+                            continue
+                        url, record = pair
+                        time = retention.parse_time(record.get('time'))
+                        if time is not None and time < cutoff:
+                            expired.append((url, record))
+                        else:
+                            kept.append(line)
+                hourly, daily = retention.roll(expired, hourly, daily, now)
+                rolled += len(expired)
+                rewrites.append((segment, kept))
+                if kept:
+                    # the following segments are newer
+                    break
+            if not rewrites:
+                hourly, daily = retention.roll(list(), hourly, daily, now)
+
+            self._replace_file(os.path.join(self.directory, self.ROLLUP_FILES[HOUR]),
+                               [json.dumps(r, sort_keys=True) + '\n' for r in hourly])
+            self._replace_file(os.path.join(self.directory, self.ROLLUP_FILES[DAY]),
+                               [json.dumps(r, sort_keys=True) + '\n' for r in daily])
+            for segment, kept in rewrites:
+                if kept:
+                    self._replace_file(segment, kept)
+                else:
+                    os.remove(segment)
+                # offsets changed, the index is rebuilt on the next query
+                self.bounds.pop(segment, None)
+                if os.path.isfile(self._index_name(segment)):
+                    os.remove(self._index_name(segment))
+        self.log.info('History compacted, {0} records rolled up'.format(rolled))
+        return rolled
+
+    def migrate(self, data_file):
+        """
+        One time import of a former 'data.file' holding the complete
+        history as a single JSON document.
+        :param data_file: name of the JSON file
+        :return: number of imported records
+        """
+        self.log.info('Migrating {0} into history {1}'.format(data_file, self.directory))
+        records = read_data_file(data_file)
+
+        # write in chunks, so the segments rotate like in normal operation
+        chunk = 1000
+        for n in range(0, len(records), chunk):
+            self.append(records[n:n + chunk])
+        self.log.info('Migrated {0} records'.format(len(records)))
+        return len(records)
+
+
+class PmonHistoryView(collections.abc.Mapping):
+    """
+    Read-only dictionary of url to list of records on top of a
+    history. Nothing is held in memory, the records are read from
+    the segments when they are accessed.
+    """
+    history = None
+
+    def __init__(self, history):
+        """
+        Constructor.
+        :param history: the PmonHistory to read from
+        """
+        self.history = history
+
+    def __getitem__(self, url):
+        records = list(self.history.read_url(url))
+        if not records:
+            raise KeyError(url)
+        return records
+
+    def __iter__(self):
+        seen = set()
+        for url, record in self.history.read():
+            if url not in seen:
+                seen.add(url)
+                yield url
+
+    def __len__(self):
+        return sum(1 for _ in self)
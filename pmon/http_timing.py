@@ -0,0 +1,152 @@
+#
+# -*- coding: utf-8-*-
+# Timing of the phases of HTTP checks.
+#
+# (c) ISC Clemenz & Weinbrecht GmbH 2018
+#
+
+import socket
+import threading
+import time
+
+import requests.adapters
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+from urllib3.util.connection import allowed_gai_family
+
+# timing of the check running in the current thread
+_local = threading.local()
+
+
+def start_timing():
+    """
+    Start collecting the phases of the requests of the current thread.
+    :return: dict filled with the seconds of the phases
+    """
+    _local.timing = dict()
+    return _local.timing
+
+
+def stop_timing():
+    """
+    Stop collecting for the current thread.
+    :return: the collected dict, rounded to microseconds
+    """
+    timing = getattr(_local, 'timing', None)
+    _local.timing = None
+    return {k: round(v, 6) for k, v in timing.items()} if timing else dict()
+
+
+def _add(phase, seconds):
+    """
+    Add the duration of a phase, phases of redirects are summed up.
+    """
+    timing = getattr(_local, 'timing', None)
+    if timing is not None:
+        timing[phase] = timing.get(phase, 0.0) + seconds
+
+
+class _TimedConnectionMixin(object):
+    """
+    Measures name resolution, TCP connect and time to first byte
+    of urllib3 connections. The name is resolved once, connect
+    tries the resolved addresses in order.
+    """
+    _pmon_sent = None
+
+    def _new_conn(self):
+        host = self._dns_host
+        start = time.monotonic()
+        try:
+            addresses = socket.getaddrinfo(host, self.port, allowed_gai_family(), socket.SOCK_STREAM)
+        except socket.gaierror:
+            # let urllib3 report the failure
+            return super()._new_conn()
+        resolved = time.monotonic()
+        _add('dns', resolved - start)
+
+        error = None
+        try:
+            for address in dict.fromkeys(a[4][0] for a in addresses):
+                self._dns_host = address
+                try:
+                    sock = super()._new_conn()
+                    _add('connect', time.monotonic() - resolved)
+                    return sock
+                except (ConnectTimeoutError, NewConnectionError) as x:
+                    error = x
+        finally:
+            self._dns_host = host
+        raise error
+
+    def request(self, *args, **kwargs):
+        super().request(*args, **kwargs)
+        self._pmon_sent = time.monotonic()
+
+    def getresponse(self, *args, **kwargs):
+        response = super().getresponse(*args, **kwargs)
+        if self._pmon_sent is not None:
+            _add('ttfb', time.monotonic() - self._pmon_sent)
+            self._pmon_sent = None
+        return response
+
+
+class PmonTimedHTTPConnection(_TimedConnectionMixin, HTTPConnection):
+    pass
+
+
+class PmonTimedHTTPSConnection(_TimedConnectionMixin, HTTPSConnection):
+    """
+    Additionally measures the TLS handshake.
+    """
+
+    def connect(self):
+        timing = getattr(_local, 'timing', None)
+        before = (timing.get('dns', 0.0) + timing.get('connect', 0.0)) if timing is not None else 0.0
+        start = time.monotonic()
+        super().connect()
+        if timing is not None:
+            after = timing.get('dns', 0.0) + timing.get('connect', 0.0)
+            _add('tls', max(0.0, time.monotonic() - start - (after - before)))
+
+
+class PmonTimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = PmonTimedHTTPConnection
+
+
+class PmonTimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = PmonTimedHTTPSConnection
+
+
+# failures name the pool and connection, e.g. 'HTTPConnectionPool(host=...)',
+# keep the messages of the checks as without timing
+for _timed, _plain in ((PmonTimedHTTPConnection, HTTPConnection),
+                       (PmonTimedHTTPSConnection, HTTPSConnection),
+                       (PmonTimedHTTPConnectionPool, HTTPConnectionPool),
+                       (PmonTimedHTTPSConnectionPool, HTTPSConnectionPool)):
+    _timed.__name__ = _plain.__name__
+    _timed.__qualname__ = _plain.__qualname__
+del _timed, _plain
+
+
+class PmonTimingAdapter(requests.adapters.HTTPAdapter):
+    """
+    Transport adapter for requests using the timed connections.
+    """
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {'http': PmonTimedHTTPConnectionPool,
+                                                   'https': PmonTimedHTTPSConnectionPool}
+
+
+def timed_session():
+    """
+    :return: a requests session measuring the phases of its requests
+    """
+    session = requests.Session()
+    adapter = PmonTimingAdapter()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
@@ -0,0 +1,104 @@
+#
+# -*- coding: utf-8-*-
+# Sending of notification mails.
+#
+# (c) ISC Clemenz & Weinbrecht GmbH 2018
+#
+
+import smtplib
+import threading
+
+
+class PmonMailer(object):
+    """
+    Sends mails through the configured SMTP server. With keep_open
+    the logged in connection is kept for the following mails, it is
+    checked with NOOP before reuse and opened again if the server
+    closed it in the meantime.
+    Cleanup requires call to 'close()'
+    """
+    log = None
+    server = None
+    port = 0
+    user = None
+    pwd = None
+    keep_open = False
+    lock = None
+    smtp = None
+
+    def __init__(self, log, server, port, user, pwd, keep_open=False):
+        """
+        Constructor.
+        :param log: the logger
+        :param server: name or ip of the mail server
+        :param port: port of the mail server
+        :param user: user to login with
+        :param pwd: password of the user
+        :param keep_open: keep the connection for the next mail
+        """
+        self.log = log
+        self.server = server
+        self.port = port
+        self.user = user
+        self.pwd = pwd
+        self.keep_open = keep_open
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        smtp = smtplib.SMTP(self.server, self.port)
+        self.log.debug("Mail server connected")
+        try:
+            smtp.login(self.user, self.pwd)
+        except Exception:
+            smtp.close()
+            raise
+        return smtp
+
+    def _connection(self):
+        if self.smtp is not None:
+            try:
+                if self.smtp.noop()[0] == 250:
+                    return self.smtp
+            except (smtplib.SMTPException, OSError):
+                pass
+            self._disconnect()
+        self.smtp = self._connect()
+        return self.smtp
+
+    def _disconnect(self):
+        if self.smtp is None:
+            return
+        try:
+            self.smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            self.smtp.close()
+        self.smtp = None
+
+    def send(self, sender, recipients, msg):
+        """
+        Send a mail.
+        :param sender: mail address of the sender
+        :param recipients: list of mail addresses
+        :param msg: the MIME message
+        :return: True if the mail has been accepted by the server
+        """
+        with self.lock:
+            try:
+                self._connection().sendmail(sender, recipients, msg.as_string())
+                self.log.debug("mail send")
+                return True
+            except Exception as x:
+                self.log.error(str(x))
+                self._disconnect()
+                return False
+            finally:
+                if not self.keep_open:
+                    self._disconnect()
+
+    def close(self):
+        """
+        Close a kept connection.
+        :return: None
+        """
+        with self.lock:
+            self._disconnect()
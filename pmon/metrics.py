@@ -0,0 +1,154 @@
+#
+# -*- coding: utf-8-*-
+# Pre-aggregated metrics in the Prometheus text format.
+#
+# (c) ISC Clemenz & Weinbrecht GmbH 2018
+#
+
+import bisect
+import threading
+
+# default upper bounds of the check duration histogram in seconds
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class PmonMetrics(object):
+    """
+    Counts every finished check into per-target aggregates: up state,
+    a duration histogram and counters per result code. Nothing of the
+    history is kept, rendering the metrics costs O(targets). Checks
+    of other processes, e.g. run by cron, are counted from their
+    latest results.
+    """
+    buckets = None
+    lock = None
+    targets = None
+    scans = 0
+    scan_seconds = 0.0
+    last_scan_seconds = None
+    # optional callable returning (scheduled, running) of the scheduler
+    queue_depth = None
+
+    def __init__(self, buckets=BUCKETS):
+        """
+        Constructor.
+        :param buckets: upper bounds of the duration histogram in seconds
+        """
+        self.buckets = tuple(sorted(buckets))
+        self.lock = threading.Lock()
+        self.targets = dict()
+
+    def observe(self, url, record):
+        """
+        Count a finished check, usable as listener of pmon.
+        :param url: the checked url
+        :param record: result of the check
+        :return: None
+        """
+        # records of the SSH sensors carry a result only on failure
+        result = record.get('result', 'SUCCESS')
+        duration = record.get('duration')
+        with self.lock:
+            target = self.targets.get(url)
+            if target is None:
+                target = {'up': 0,
+                          'time': None,
+                          'results': dict(),
+                          'buckets': [0] * len(self.buckets),
+                          'count': 0,
+                          'sum': 0.0}
+                self.targets[url] = target
+            target['up'] = 1 if result == 'SUCCESS' else 0
+            target['time'] = str(record.get('time'))
+            target['results'][result] = target['results'].get(result, 0) + 1
+            if duration is not None:
+                n = bisect.bisect_left(self.buckets, duration)
+                if n < len(self.buckets):
+                    target['buckets'][n] += 1
+                target['count'] += 1
+                target['sum'] += duration
+
+    def observe_latest(self, results):
+        """
+        Count the checks of a latest result file not counted yet, a
+        check is identified by url and time.
+        :param results: dictionary of url to the record of its last check
+        :return: None
+        """
+        for url, record in results.items():
+            if not isinstance(record, dict):
+                continue
+            with self.lock:
+                target = self.targets.get(url)
+                counted = target is not None and target['time'] == str(record.get('time'))
+            if not counted:
+                self.observe(url, record)
+
+    def scan_done(self, seconds):
+        """
+        Count a finished scan.
+        :param seconds: duration of the scan
+        :return: None
+        """
+        with self.lock:
+            self.scans += 1
+            self.scan_seconds += seconds
+            self.last_scan_seconds = seconds
+
+    @staticmethod
+    def _label(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    def render(self):
+        """
+        :return: the metrics in the Prometheus text exposition format
+        """
+        lines = list()
+        with self.lock:
+            targets = sorted(self.targets.items())
+            lines.append('# HELP pmon_up 1 if the last check of the target succeeded')
+            lines.append('# TYPE pmon_up gauge')
+            for url, target in targets:
+                lines.append('pmon_up{{url="{0}"}} {1}'.format(self._label(url), target['up']))
+
+            lines.append('# HELP pmon_checks_total Checks of the target by result code')
+            lines.append('# TYPE pmon_checks_total counter')
+            for url, target in targets:
+                for result, count in sorted(target['results'].items()):
+                    lines.append('pmon_checks_total{{url="{0}",result="{1}"}} {2}'.format(
+                        self._label(url), self._label(result), count))
+
+            lines.append('# HELP pmon_check_duration_seconds Duration of the checks of the target')
+            lines.append('# TYPE pmon_check_duration_seconds histogram')
+            for url, target in targets:
+                label = self._label(url)
+                cumulative = 0
+                for bound, count in zip(self.buckets, target['buckets']):
+                    cumulative += count
+                    lines.append('pmon_check_duration_seconds_bucket{{url="{0}",le="{1}"}} {2}'.format(
+                        label, bound, cumulative))
+                lines.append('pmon_check_duration_seconds_bucket{{url="{0}",le="+Inf"}} {1}'.format(
+                    label, target['count']))
+                lines.append('pmon_check_duration_seconds_sum{{url="{0}"}} {1}'.format(label, target['sum']))
+                lines.append('pmon_check_duration_seconds_count{{url="{0}"}} {1}'.format(label, target['count']))
+
+            lines.append('# HELP pmon_scans_total Completed scans')
+            lines.append('# TYPE pmon_scans_total counter')
+            lines.append('pmon_scans_total {0}'.format(self.scans))
+            lines.append('# HELP pmon_scan_seconds_total Time spent in scans')
+            lines.append('# TYPE pmon_scan_seconds_total counter')
+            lines.append('pmon_scan_seconds_total {0}'.format(self.scan_seconds))
+            if self.last_scan_seconds is not None:
+                lines.append('# HELP pmon_last_scan_seconds Duration of the last scan')
+                lines.append('# TYPE pmon_last_scan_seconds gauge')
+                lines.append('pmon_last_scan_seconds {0}'.format(self.last_scan_seconds))
+
+        if self.queue_depth is not None:
+            scheduled, running = self.queue_depth()
+            lines.append('# HELP pmon_checks_scheduled Checks waiting in the scheduler')
+            lines.append('# TYPE pmon_checks_scheduled gauge')
+            lines.append('pmon_checks_scheduled {0}'.format(scheduled))
+            lines.append('# HELP pmon_checks_running Checks running in the scheduler')
+            lines.append('# TYPE pmon_checks_running gauge')
+            lines.append('pmon_checks_running {0}'.format(running))
+        return '\n'.join(lines) + '\n'
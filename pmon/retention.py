@@ -0,0 +1,168 @@
+#
+# -*- coding: utf-8-*-
+# Retention tiers and rollups of the result history.
+#
+# (c) ISC Clemenz & Weinbrecht GmbH 2018
+#
+
+import datetime
+
+HOUR = 'hour'
+DAY = 'day'
+
+
+class PmonRetention(object):
+    """
+    Retention policy of the history. Raw records are kept for a
+    number of days, older ones are condensed into hourly rollups.
+    Hourly rollups are condensed into daily rollups after their
+    own period, daily rollups are dropped after theirs. A period
+    of 0 days keeps the data forever.
+
+    A rollup is a dictionary with url, period, start time, number
+    of checks per result code and the aggregated check durations.
+    """
+    raw_days = 0
+    hourly_days = 0
+    daily_days = 0
+
+    def __init__(self, raw_days, hourly_days, daily_days):
+        """
+        Constructor.
+        :param raw_days: days to keep raw records, 0 disables the retention
+        :param hourly_days: days to keep hourly rollups, 0 keeps them forever
+        :param daily_days: days to keep daily rollups, 0 keeps them forever
+        """
+        self.raw_days = raw_days
+        self.hourly_days = hourly_days
+        self.daily_days = daily_days
+
+    def enabled(self):
+        """
+        :return: True if raw records expire at all
+        """
+        return self.raw_days > 0
+
+    @staticmethod
+    def _cutoff(now, days):
+        return now - datetime.timedelta(days=days) if days > 0 else None
+
+    def raw_cutoff(self, now):
+        """
+        :param now: the current time
+        :return: raw records before this time are rolled up, None if they are kept forever
+        """
+        return self._cutoff(now, self.raw_days)
+
+    @staticmethod
+    def parse_time(value):
+        """
+        :param value: time of a record, string or datetime
+        :return: the time as datetime, None if not parsable
+        """
+        if isinstance(value, datetime.datetime):
+            return value
+        try:
+            return datetime.datetime.fromisoformat(str(value))
+        except ValueError:
+            return None
+
+    @staticmethod
+    def bucket(time, period):
+        """
+        :param time: a datetime
+        :param period: HOUR or DAY
+        :return: start of the period containing time
+        """
+        if period == HOUR:
+            return time.replace(minute=0, second=0, microsecond=0)
+        return time.replace(hour=0, minute=0, second=0, microsecond=0)
+
+    @staticmethod
+    def new_rollup(url, period, start):
+        return {'url': url,
+                'period': period,
+                'time': start.__str__(),
+                'count': 0,
+                'results': dict(),
+                'duration': {'count': 0, 'min': None, 'max': None, 'sum': 0.0}}
+
+    @staticmethod
+    def _add_duration(target, count, d_min, d_max, d_sum):
+        if count == 0:
+            return
+        target['count'] += count
+        target['sum'] += d_sum
+        target['min'] = d_min if target['min'] is None else min(target['min'], d_min)
+        target['max'] = d_max if target['max'] is None else max(target['max'], d_max)
+
+    @staticmethod
+    def add_record(rollup, record):
+        """
+        Count a raw record into a rollup.
+        :param rollup: the rollup
+        :param record: the check record
+        :return: None
+        """
+        result = record.get('result', 'UNKNOWN')
+        rollup['count'] += 1
+        rollup['results'][result] = rollup['results'].get(result, 0) + 1
+        duration = record.get('duration')
+        if isinstance(duration, (int, float)):
+            PmonRetention._add_duration(rollup['duration'], 1, duration, duration, duration)
+
+    @staticmethod
+    def merge_rollup(rollup, other):
+        """
+        Add the counts of another rollup into a rollup.
+        :param rollup: the rollup to change
+        :param other: the rollup to add
+        :return: None
+        """
+        rollup['count'] += other['count']
+        for result, count in other['results'].items():
+            rollup['results'][result] = rollup['results'].get(result, 0) + count
+        d = other['duration']
+        PmonRetention._add_duration(rollup['duration'], d['count'], d['min'], d['max'], d['sum'])
+
+    def roll(self, expired, hourly, daily, now):
+        """
+        Apply the retention tiers.
+        :param expired: iterable of (url, record) pairs of expired raw records
+        :param hourly: list of existing hourly rollups
+        :param daily: list of existing daily rollups
+        :param now: the current time
+        :return: the new (hourly, daily) rollup lists, sorted by time
+        """
+        hours = dict(((r['url'], r['time']), r) for r in hourly)
+        for url, record in expired:
+            time = self.parse_time(record.get('time'))
+            if time is None:
+                continue
+            start = self.bucket(time, HOUR)
+            key = (url, start.__str__())
+            if key not in hours:
+                hours[key] = self.new_rollup(url, HOUR, start)
+            self.add_record(hours[key], record)
+
+        days = dict(((r['url'], r['time']), r) for r in daily)
+        hourly_cutoff = self._cutoff(now, self.hourly_days)
+        if hourly_cutoff is not None:
+            for key, rollup in list(hours.items()):
+                start = self.parse_time(rollup['time'])
+                if start < hourly_cutoff:
+                    day = self.bucket(start, DAY)
+                    day_key = (rollup['url'], day.__str__())
+                    if day_key not in days:
+                        days[day_key] = self.new_rollup(rollup['url'], DAY, day)
+                    self.merge_rollup(days[day_key], rollup)
+                    del hours[key]
+
+        daily_cutoff = self._cutoff(now, self.daily_days)
+        if daily_cutoff is not None:
+            days = dict((k, r) for k, r in days.items() if self.parse_time(r['time']) >= daily_cutoff)
+
+        def by_time(r):
+            return r['time'], r['url']
+
+        return sorted(hours.values(), key=by_time), sorted(days.values(), key=by_time)
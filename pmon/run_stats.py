@@ -0,0 +1,135 @@
+#
+# -*- coding: utf-8-*-
+# Timing of the phases and checks of a run, and profiling.
+#
+# (c) ISC Clemenz & Weinbrecht GmbH 2018
+#
+
+import contextlib
+import cProfile
+import datetime
+import pstats
+import threading
+import time
+
+# number of the slowest checks listed in the summary
+SLOWEST = 5
+
+
+class PmonRunStats(object):
+    """
+    Collects the durations of the phases of a run and of every check,
+    measured with the monotonic clock. Phases measured more than once
+    are summed up, nested phases are measured independently.
+    """
+    lock = None
+    started = None
+    start = None
+    phases = None
+    checks = None
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = datetime.datetime.now()
+        self.start = time.monotonic()
+        self.phases = dict()
+        self.checks = list()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """
+        Measure a phase, usable as 'with stats.phase("save"):'
+        :param name: name of the phase
+        """
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add_phase(name, time.monotonic() - start)
+
+    def add_phase(self, name, seconds):
+        with self.lock:
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def add_check(self, url, seconds):
+        """
+        :param url: the checked url
+        :param seconds: duration of the check including the sensors
+        :return: None
+        """
+        with self.lock:
+            self.checks.append((seconds, url))
+
+    def summary(self, run_id):
+        """
+        :param run_id: id of the monitor
+        :return: dict of the run, JSON serializable
+        """
+        with self.lock:
+            checks = sorted(self.checks, reverse=True)
+            phases = {name: round(seconds, 6) for name, seconds in self.phases.items()}
+        durations = [seconds for seconds, _ in checks]
+        summary = {'id': run_id,
+                   'time': self.started.__str__(),
+                   'total': round(time.monotonic() - self.start, 6),
+                   'phases': phases,
+                   'checks': len(checks)}
+        if checks:
+            summary['check'] = {'min': round(durations[-1], 6),
+                                'max': round(durations[0], 6),
+                                'mean': round(sum(durations) / len(durations), 6),
+                                'p95': round(durations[int(len(durations) * 0.05)], 6),
+                                'slowest': [[url, round(seconds, 6)] for seconds, url in checks[:SLOWEST]]}
+        return summary
+
+
+class PmonProfiler(object):
+    """
+    cProfile of the calling thread and of all threads started while
+    it runs, e.g. the workers of the scans. The profiles are merged
+    into one stats file readable with pstats or snakeviz.
+    """
+    file_name = None
+    main = None
+    lock = None
+    profiles = None
+
+    def __init__(self, file_name):
+        """
+        Constructor.
+        :param file_name: name of the stats file written by stop()
+        """
+        self.file_name = file_name
+        self.lock = threading.Lock()
+        self.profiles = list()
+
+    def __start_thread(self, frame, event, arg):
+        # called once by every new thread, replaced by its own profile
+        profile = cProfile.Profile()
+        with self.lock:
+            self.profiles.append(profile)
+        profile.enable()
+
+    def start(self):
+        threading.setprofile(self.__start_thread)
+        self.main = cProfile.Profile()
+        self.main.enable()
+        return self
+
+    def stop(self):
+        """
+        End profiling and write the merged stats.
+        :return: None
+        """
+        self.main.disable()
+        threading.setprofile(None)
+        stats = pstats.Stats(self.main)
+        with self.lock:
+            profiles = list(self.profiles)
+        for profile in profiles:
+            try:
+                stats.add(profile)
+            except TypeError:
+                # thread ended before calling any function
+                pass
+        stats.dump_stats(self.file_name)
@@ -0,0 +1,118 @@
+#
+# -*- coding: utf-8-*-
+# Background execution of forced scans.
+#
+# (c) ISC Clemenz & Weinbrecht GmbH 2018
+#
+
+import collections
+import datetime
+import itertools
+import threading
+
+
+class PmonScanJobs(object):
+    """
+    Runs forced scans in a single background thread. A request
+    while a scan is queued or running joins that scan instead of
+    starting another one, so scans never overlap. The state of the
+    most recent jobs is kept for status queries.
+    """
+    KEEP = 20
+
+    log = None
+    scan_callback = None
+    on_done = None
+    lock = None
+    jobs = None
+    current = None
+    ids = None
+
+    def __init__(self, log, scan_callback, on_done=None):
+        """
+        Constructor.
+        :param log: the logger
+        :param scan_callback: callable(nomail_flag, progress) doing the scan
+        :param on_done: optional callable(job) invoked after a job finished
+        """
+        self.log = log
+        self.scan_callback = scan_callback
+        self.on_done = on_done
+        self.lock = threading.Lock()
+        self.jobs = collections.OrderedDict()
+        self.ids = itertools.count(1)
+
+    def request(self, nomail_flag):
+        """
+        Request a scan. Joins the scan in flight, if there is one.
+        :param nomail_flag: no notification mail if True
+        :return: copy of the job state
+        """
+        with self.lock:
+            if self.current is not None:
+                job = self.current
+                # a waiting job can still be asked to send mail
+                if job['state'] == 'queued' and not nomail_flag:
+                    job['nomail'] = False
+                self.log.debug('Scan request joins job {0}'.format(job['id']))
+                return dict(job)
+
+            job = {'id': str(next(self.ids)),
+                   'state': 'queued',
+                   'nomail': nomail_flag,
+                   'done': 0,
+                   'total': None,
+                   'requested': datetime.datetime.now().__str__(),
+                   'started': None,
+                   'finished': None,
+                   'error': None}
+            self.jobs[job['id']] = job
+            while len(self.jobs) > self.KEEP:
+                self.jobs.popitem(last=False)
+            self.current = job
+            threading.Thread(target=self.__run,
+                             args=(job,),
+                             name='pmon-scan-job-' + job['id'],
+                             daemon=True).start()
+            self.log.info('Scan job {0} started'.format(job['id']))
+            return dict(job)
+
+    def status(self, job_id=None):
+        """
+        :param job_id: id of a job, None for the most recent one
+        :return: copy of the job state, None if unknown
+        """
+        with self.lock:
+            if job_id is None:
+                job = next(reversed(self.jobs.values()), None)
+            else:
+                job = self.jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def __progress(self, job, done, total):
+        with self.lock:
+            job['done'] = done
+            job['total'] = total
+
+    def __run(self, job):
+        with self.lock:
+            job['state'] = 'running'
+            job['started'] = datetime.datetime.now().__str__()
+            nomail_flag = job['nomail']
+        try:
+            self.scan_callback(nomail_flag, lambda done, total: self.__progress(job, done, total))
+            state, error = 'done', None
+        except Exception as x:
+            self.log.error('Scan job {0} failed: {1}'.format(job['id'], str(x)))
+            state, error = 'failed', str(x)
+        with self.lock:
+            job['state'] = state
+            job['error'] = error
+            job['finished'] = datetime.datetime.now().__str__()
+            self.current = None
+        self.log.info('Scan job {0} {1}'.format(job['id'], state))
+        if self.on_done is not None:
+            try:
+                self.on_done(dict(job))
+            except Exception as x:
+                self.log.error(str(x))
@@ -0,0 +1,81 @@
+#
+# -*- coding: utf-8-*-
+# Concurrent execution of the checks of one scan.
+#
+# (c) ISC Clemenz & Weinbrecht GmbH 2018
+#
+
+import collections
+import concurrent.futures
+import urllib.parse
+
+
+class PmonScanner(object):
+    """
+    Runs the checks of a scan in a thread pool. The number of
+    checks in flight is bounded globally by the pool size and
+    per host by the host limit, so a single slow machine can not
+    occupy all workers.
+    """
+    log = None
+    workers = 1
+    host_workers = 1
+
+    def __init__(self, log, workers, host_workers):
+        """
+        Constructor.
+        :param log: the logger
+        :param workers: maximum number of checks running at once
+        :param host_workers: maximum number of checks running at once against one host
+        """
+        self.log = log
+        self.workers = max(1, workers)
+        self.host_workers = max(1, host_workers)
+
+    @staticmethod
+    def host_of(url):
+        """
+        :param url: the url of a target
+        :return: the host part used to group targets, the url itself if there is none
+        """
+        host = urllib.parse.urlparse(url).hostname
+        return host if host else url
+
+    def scan(self, targets, check, done_callback=None):
+        """
+        Execute the check for all targets and wait for all of them.
+        :param targets: list of (config-key, url) pairs
+        :param check: callable invoked with the config-key of a target
+        :param done_callback: optional callable invoked with the config-key after each check
+        :return: None
+        """
+        pending = collections.OrderedDict()
+        for cfg_name, url in targets:
+            pending.setdefault(self.host_of(url), collections.deque()).append(cfg_name)
+
+        self.log.debug('scan {0} targets on {1} hosts'.format(len(targets), len(pending)))
+        active = collections.Counter()
+        running = dict()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers,
+                                                   thread_name_prefix='pmon-scan') as pool:
+            while pending or running:
+                for host in list(pending.keys()):
+                    queue = pending[host]
+                    while queue and active[host] < self.host_workers:
+                        cfg_name = queue.popleft()
+                        running[pool.submit(check, cfg_name)] = (host, cfg_name)
+                        active[host] += 1
+                    if not queue:
+                        del pending[host]
+
+                done, _ = concurrent.futures.wait(running.keys(),
+                                                  return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    host, cfg_name = running.pop(future)
+                    active[host] -= 1
+                    try:
+                        future.result()
+                    except Exception as x:
+                        self.log.error('Check {0} failed: {1}'.format(cfg_name, str(x)))
+                    if done_callback is not None:
+                        done_callback(cfg_name)
@@ -0,0 +1,237 @@
+#
+# -*- coding: utf-8-*-
+# In-process scheduler of the daemon mode.
+#
+# (c) ISC Clemenz & Weinbrecht GmbH 2018
+#
+
+import concurrent.futures
+import heapq
+import itertools
+import random
+import threading
+import time
+
+from pmon.scanner import PmonScanner
+
+
+class PmonScheduler(object):
+    """
+    Runs the checks of the targets continuously, each one at its
+    own interval with a random jitter, so the checks spread over
+    time instead of all hitting at once. A check is scheduled again
+    after it finished, so checks of one target never overlap.
+    Checks run in a thread pool, limited per host like a scan.
+    Periodic tasks, like saving the results, run in the scheduler
+    thread itself.
+
+    With adaptive intervals a target that just changed its state is
+    checked again at the confirm interval a few times. A target that
+    stays down backs off exponentially from its interval up to the
+    backoff maximum. Healthy targets keep their interval.
+    """
+    log = None
+    workers = 1
+    host_workers = 1
+    lock = None
+    stopped = None
+    heap = None
+    # config-key -> entry of the scheduled checks
+    checks = None
+    seq = None
+    host_locks = None
+    running = 0
+    confirm_interval = 0
+    confirm_count = 0
+    backoff_max = 0
+
+    def __init__(self, log, workers, host_workers):
+        """
+        Constructor.
+        :param log: the logger
+        :param workers: maximum number of checks running at once
+        :param host_workers: maximum number of checks running at once against one host
+        """
+        self.log = log
+        self.workers = max(1, workers)
+        self.host_workers = max(1, host_workers)
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.heap = list()
+        self.checks = dict()
+        self.seq = itertools.count()
+        self.host_locks = dict()
+
+    def adaptive(self, confirm_interval, confirm_count, backoff_max):
+        """
+        Enable adaptive intervals.
+        :param confirm_interval: seconds until the next check after a change of state
+        :param confirm_count: number of checks at the confirm interval after a change
+        :param backoff_max: maximum seconds between two checks of a target staying down
+        :return: None
+        """
+        self.confirm_interval = confirm_interval
+        self.confirm_count = confirm_count
+        self.backoff_max = backoff_max
+
+    def next_interval(self, entry, up):
+        """
+        Update the state of a target with the result of its check.
+        :param entry: the scheduled check
+        :param up: True if the check succeeded
+        :return: seconds until the next check
+        """
+        if entry['up'] is not None and up != entry['up']:
+            self.log.info('{0} is {1} now'.format(entry['name'], 'up' if up else 'down'))
+            entry['confirm'] = self.confirm_count
+            entry['down'] = 0
+        entry['up'] = up
+        if entry['confirm'] > 0:
+            entry['confirm'] -= 1
+            return self.confirm_interval
+        if up or self.backoff_max <= 0:
+            return entry['interval']
+        entry['down'] += 1
+        return min(entry['interval'] * 2 ** (entry['down'] - 1), max(self.backoff_max, entry['interval']))
+
+    def _push(self, due, entry):
+        with self.lock:
+            heapq.heappush(self.heap, (due, next(self.seq), entry))
+
+    @staticmethod
+    def _next_due(entry, now, interval=None):
+        jitter = entry['jitter']
+        interval = entry['interval'] if interval is None else interval
+        return now + max(0.0, interval + random.uniform(-jitter, jitter))
+
+    def add_check(self, cfg_name, url, interval, jitter, check):
+        """
+        Schedule the check of a target. The first check is due within the jitter.
+        :param cfg_name: config-key of the target
+        :param url: url of the target
+        :param interval: seconds between two checks
+        :param jitter: maximum random deviation from the interval in seconds
+        :param check: callable invoked with the config-key, returns True if the target is up
+        :return: None
+        """
+        entry = {'name': cfg_name,
+                 'url': url,
+                 'host': PmonScanner.host_of(url),
+                 'interval': interval,
+                 'jitter': jitter,
+                 'callback': check,
+                 'check': True,
+                 'removed': False,
+                 'up': None,
+                 'confirm': 0,
+                 'down': 0}
+        with self.lock:
+            self.checks[cfg_name] = entry
+        self._push(time.monotonic() + random.uniform(0, jitter), entry)
+
+    def update_checks(self, checks, check):
+        """
+        Replace the scheduled checks by those of a new configuration.
+        Unchanged targets keep their state and due time, new intervals
+        apply from their next check on. Removed targets are dropped,
+        a running check of them finishes but is not scheduled again.
+        :param checks: list of (config-key, url, interval, jitter)
+        :param check: callable for the added targets, see add_check()
+        :return: None
+        """
+        added = list()
+        with self.lock:
+            keep = set(c[0] for c in checks)
+            for cfg_name in [n for n in self.checks if n not in keep]:
+                self.checks.pop(cfg_name)['removed'] = True
+            self.heap = [e for e in self.heap if not e[2].get('removed')]
+            heapq.heapify(self.heap)
+            for cfg_name, url, interval, jitter in checks:
+                entry = self.checks.get(cfg_name)
+                if entry is None:
+                    added.append((cfg_name, url, interval, jitter))
+                    continue
+                if entry['url'] != url:
+                    # another target under the same key starts without state
+                    entry.update({'url': url, 'host': PmonScanner.host_of(url),
+                                  'up': None, 'confirm': 0, 'down': 0})
+                entry['interval'] = interval
+                entry['jitter'] = jitter
+        for cfg_name, url, interval, jitter in added:
+            self.add_check(cfg_name, url, interval, jitter, check)
+
+    def add_task(self, name, interval, callback):
+        """
+        Schedule a periodic task, first run after one interval.
+        :param name: name of the task for logging
+        :param interval: seconds between two runs
+        :param callback: callable without arguments
+        :return: None
+        """
+        entry = {'name': name,
+                 'interval': interval,
+                 'jitter': 0,
+                 'callback': callback,
+                 'check': False}
+        self._push(time.monotonic() + interval, entry)
+
+    def queue_depth(self):
+        """
+        :return: (scheduled, running) number of checks
+        """
+        with self.lock:
+            return sum(1 for e in self.heap if e[2]['check']), self.running
+
+    def _run_check(self, entry):
+        with self.lock:
+            host_lock = self.host_locks.setdefault(entry['host'],
+                                                   threading.BoundedSemaphore(self.host_workers))
+        up = False
+        with host_lock:
+            try:
+                up = bool(entry['callback'](entry['name']))
+            except Exception as x:
+                self.log.error('Check {0} failed: {1}'.format(entry['name'], str(x)))
+        with self.lock:
+            self.running -= 1
+            if entry['removed']:
+                return
+            interval = self.next_interval(entry, up)
+        self._push(self._next_due(entry, time.monotonic(), interval), entry)
+
+    def run(self):
+        """
+        Execute the scheduled checks and tasks until stop() is called.
+        Waits for the running checks before returning.
+        :return: None
+        """
+        self.log.info('Scheduler started')
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers,
+                                                   thread_name_prefix='pmon-check') as pool:
+            while not self.stopped.is_set():
+                due = list()
+                with self.lock:
+                    now = time.monotonic()
+                    while self.heap and self.heap[0][0] <= now:
+                        due.append(heapq.heappop(self.heap)[2])
+                    wait = self.heap[0][0] - now if self.heap else 1.0
+                for entry in due:
+                    if entry['check']:
+                        with self.lock:
+                            self.running += 1
+                        pool.submit(self._run_check, entry)
+                    else:
+                        try:
+                            entry['callback']()
+                        except Exception as x:
+                            self.log.error('Task {0} failed: {1}'.format(entry['name'], str(x)))
+                        self._push(self._next_due(entry, time.monotonic()), entry)
+                self.stopped.wait(min(max(wait, 0.0), 1.0))
+        self.log.info('Scheduler stopped')
+
+    def stop(self):
+        """
+        Ask run() to return.
+        :return: None
+        """
+        self.stopped.set()
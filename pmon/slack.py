@@ -0,0 +1,181 @@
+#
+# -*- coding: utf-8-*-
+# Batched forwarding of messages to a Slack-Webhook.
+#
+# (c) ISC Clemenz & Weinbrecht GmbH 2018
+#
+
+import collections
+import json
+import threading
+import time
+
+import requests
+
+
+class PmonSlackForwarder(object):
+    """
+    Collects messages and posts them to an incoming Slack-Webhook
+    from a single background thread. Messages arriving within the
+    window are merged into one post with an attachment per message,
+    identical messages are collapsed into one attachment with their
+    count. At most one post per window is sent, failed posts are
+    retried with exponential backoff, honoring 'Retry-After'.
+    Cleanup requires call to 'close()'
+    """
+    # limit of attachments of one Slack message
+    MAX_ATTACHMENTS = 100
+    # limit of distinct messages waiting for the next post
+    MAX_PENDING = 1000
+
+    log = None
+    hook = None
+    window = 1.0
+    retries = 5
+    session = None
+    lock = None
+    pending = None
+    wakeup = None
+    closed = False
+    thread = None
+    dropped = 0
+
+    def __init__(self, log, hook, window, retries):
+        """
+        Constructor.
+        :param log: the logger
+        :param hook: URL of the Slack-Webhook
+        :param window: seconds messages are collected into one post
+        :param retries: number of retries of a failed post before it is dropped
+        """
+        self.log = log
+        self.hook = hook
+        if not hook:
+            self.log.warning("No slack.hook configured, messages are not forwarded")
+        self.window = window
+        self.retries = retries
+        self.session = requests.Session()
+        self.session.headers.update({'Accept': 'application/json',
+                                     'Content-Type': 'application/json'})
+        self.lock = threading.Lock()
+        self.pending = collections.OrderedDict()
+        self.wakeup = threading.Event()
+        self.thread = threading.Thread(target=self.__run, name='pmon-slack', daemon=True)
+        self.thread.start()
+
+    @staticmethod
+    def _key(message):
+        return message['msg.type'], message['from'], message['msg']
+
+    def submit(self, message):
+        """
+        Queue a message for the next post.
+        :param message: the message record with 'msg', 'msg.type' and 'from'
+        :return: None
+        """
+        if not self.hook:
+            self.log.debug("Message not forwarded, no slack.hook: {0}".format(message['msg']))
+            return
+        with self.lock:
+            key = self._key(message)
+            if key in self.pending:
+                self.pending[key][1] += 1
+            elif len(self.pending) < self.MAX_PENDING:
+                self.pending[key] = [message, 1]
+            else:
+                self.dropped += 1
+        self.wakeup.set()
+
+    @staticmethod
+    def _attachment(message, count):
+        text = message['msg'] if count == 1 else '{0} (repeated {1} times)'.format(message['msg'], count)
+        return {'fallback': text,
+                'text': text,
+                'title': message['msg.type'],
+                'author_name': message['from']}
+
+    @classmethod
+    def make_payloads(cls, batch):
+        """
+        :param batch: list of (message, count) in arrival order
+        :return: list of Slack payloads, one per MAX_ATTACHMENTS messages
+        """
+        payloads = list()
+        for n in range(0, len(batch), cls.MAX_ATTACHMENTS):
+            chunk = batch[n:n + cls.MAX_ATTACHMENTS]
+            total = sum(count for _, count in chunk)
+            payloads.append({'text': chunk[0][0]['msg'] if total == 1 else '{0} messages'.format(total),
+                             'attachments': [cls._attachment(m, c) for m, c in chunk]})
+        return payloads
+
+    def _post(self, payload):
+        """
+        Post one payload, retried with backoff.
+        :return: True if it has been accepted
+        """
+        data = json.dumps(payload)
+        delay = self.window
+        for attempt in range(self.retries + 1):
+            try:
+                rsp = self.session.post(self.hook, data=data, timeout=10)
+                if rsp.status_code == requests.codes.ok:
+                    return True
+                self.log.warning("problem sending to slack: {0}".format(rsp.status_code))
+                if rsp.status_code == requests.codes.too_many_requests:
+                    try:
+                        delay = max(delay, float(rsp.headers.get('Retry-After', delay)))
+                    except ValueError:
+                        pass
+                elif rsp.status_code < 500:
+                    # the payload itself is refused, retrying does not help
+                    return False
+            except (requests.exceptions.InvalidURL,
+                    requests.exceptions.MissingSchema,
+                    requests.exceptions.InvalidSchema) as x:
+                # the hook is misconfigured, retrying does not help
+                self.log.error(str(x))
+                return False
+            except Exception as x:
+                self.log.error(str(x))
+            if attempt < self.retries:
+                time.sleep(delay)
+                delay *= 2
+        self.log.error("Dropped slack post of {0} attachments".format(len(payload['attachments'])))
+        return False
+
+    def flush(self):
+        """
+        Post the queued messages.
+        :return: None
+        """
+        with self.lock:
+            batch = list(self.pending.values())
+            self.pending.clear()
+            dropped, self.dropped = self.dropped, 0
+        if dropped:
+            self.log.warning("Dropped {0} messages for slack, too many pending".format(dropped))
+        if batch:
+            self.log.debug("Forwarding {0} messages to slack".format(len(batch)))
+        for payload in self.make_payloads(batch):
+            self._post(payload)
+
+    def __run(self):
+        while not self.closed:
+            self.wakeup.wait()
+            if self.closed:
+                return
+            # collect the messages of the window into one post
+            time.sleep(self.window)
+            self.wakeup.clear()
+            self.flush()
+
+    def close(self):
+        """
+        Post the remaining messages and stop the background thread.
+        :return: None
+        """
+        self.closed = True
+        self.wakeup.set()
+        self.thread.join()
+        self.flush()
+        self.session.close()
@@ -0,0 +1,283 @@
+#
+# -*- coding: utf-8-*-
+# Result history in an indexed SQLite database.
+#
+# (c) ISC Clemenz & Weinbrecht GmbH 2018
+#
+
+import datetime
+import json
+import sqlite3
+import threading
+
+from pmon.history import read_data_file, time_key
+from pmon.retention import HOUR, DAY
+
+
+class PmonSqliteHistory(object):
+    """
+    Result history stored in a SQLite database. The records are
+    indexed by url and time, so the records of one target within a
+    time range are read without scanning the whole history. Offers
+    the same operations as PmonHistory.
+    """
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS records ('
+        ' id INTEGER PRIMARY KEY,'
+        ' url TEXT NOT NULL,'
+        ' time TEXT NOT NULL,'
+        ' result TEXT,'
+        ' record TEXT NOT NULL)',
+        'CREATE INDEX IF NOT EXISTS records_url_time ON records (url, time)',
+        'CREATE INDEX IF NOT EXISTS records_time ON records (time)',
+        'CREATE TABLE IF NOT EXISTS rollups ('
+        ' period TEXT NOT NULL,'
+        ' url TEXT NOT NULL,'
+        ' time TEXT NOT NULL,'
+        ' rollup TEXT NOT NULL,'
+        ' PRIMARY KEY (period, url, time))',
+        'CREATE TABLE IF NOT EXISTS runs ('
+        ' id INTEGER PRIMARY KEY,'
+        ' time TEXT NOT NULL,'
+        ' run TEXT NOT NULL)'
+    )
+
+    # PRAGMA user_version of the database, 1 since the times are normalized
+    VERSION = 1
+
+    log = None
+    db_file = None
+    db = None
+    lock = None
+
+    def __init__(self, log, db_file):
+        """
+        Constructor.
+        :param log: the logger
+        :param db_file: name of the database file, created if missing
+        """
+        self.log = log
+        self.db_file = db_file
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(db_file, check_same_thread=False)
+        with self.lock, self.db:
+            self.db.execute('PRAGMA journal_mode=WAL')
+            for statement in self.SCHEMA:
+                self.db.execute(statement)
+            if self.db.execute('PRAGMA user_version').fetchone()[0] < self.VERSION:
+                self._normalize_times()
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+    @staticmethod
+    def _datetime_converter(o):
+        """
+        Converter for JSON output
+        :param o: value to convert to a string
+        :return: string representation of the value
+        """
+        if isinstance(o, datetime.datetime):
+            return o.__str__()
+
+    @staticmethod
+    def _time_key(value):
+        """
+        :param value: datetime or time string of a record
+        :return: the time as sortable string, like the index of PmonHistory
+        """
+        return time_key(value)
+
+    def _normalize_times(self):
+        """
+        One time conversion of the times stored by former versions
+        as given, e.g. without microseconds. Call with the lock held.
+        """
+        rows = self.db.execute('SELECT id, time FROM records').fetchall()
+        updates = [(self._time_key(time), row_id) for row_id, time in rows if self._time_key(time) != time]
+        self.db.executemany('UPDATE records SET time = ? WHERE id = ?', updates)
+        self.db.execute('PRAGMA user_version = {0}'.format(self.VERSION))
+        if updates:
+            self.log.info('Normalized the times of {0} records'.format(len(updates)))
+
+    def _select(self, sql, parameters=()):
+        """
+        Run a query and fetch the rows in chunks, so large results
+        are not held in memory.
+        :return: generator of rows
+        """
+        with self.lock:
+            cursor = self.db.execute(sql, parameters)
+        while True:
+            with self.lock:
+                rows = cursor.fetchmany(500)
+            if not rows:
+                return
+            for row in rows:
+                yield row
+
+    def is_empty(self):
+        """
+        :return: True if no record has been written yet
+        """
+        with self.lock:
+            return self.db.execute('SELECT 1 FROM records LIMIT 1').fetchone() is None
+
+    def append(self, records):
+        """
+        Insert the records of a run in one transaction.
+        :param records: list of (url, record) pairs
+        :return: None
+        """
+        if not records:
+            return
+        rows = [(url,
+                 self._time_key(record.get('time')),
+                 record.get('result'),
+                 json.dumps(record, sort_keys=True, default=self._datetime_converter))
+                for url, record in records]
+        with self.lock, self.db:
+            self.db.executemany('INSERT INTO records (url, time, result, record) VALUES (?, ?, ?, ?)', rows)
+        self.log.debug('{0} records inserted into history'.format(len(records)))
+
+    def read(self):
+        """
+        Read all records, oldest first.
+        :return: generator of (url, record) pairs
+        """
+        for url, record in self._select('SELECT url, record FROM records ORDER BY time, id'):
+            yield url, json.loads(record)
+
+    def read_url(self, url):
+        """
+        Read the records of one url, oldest first.
+        :param url: the url
+        :return: generator of records
+        """
+        return self.query(url)
+
+    def query(self, url, since=None, until=None):
+        """
+        Read the records of one url within a time range using the index.
+        :param url: the url
+        :param since: datetime of the range start (inclusive), None for open
+        :param until: datetime of the range end (exclusive), None for open
+        :return: generator of records, oldest first
+        """
+        sql = 'SELECT record FROM records WHERE url = ?'
+        parameters = [url]
+        if since is not None:
+            sql += ' AND time >= ?'
+            parameters.append(self._time_key(since))
+        if until is not None:
+            sql += ' AND time < ?'
+            parameters.append(self._time_key(until))
+        sql += ' ORDER BY time, id'
+        for row in self._select(sql, parameters):
+            yield json.loads(row[0])
+
+    def find(self, url=None, since=None, until=None, results=None, after=None):
+        """
+        Read the records matching a query using the indexes, oldest first.
+        :param url: the url, None for all
+        :param since: datetime of the range start (inclusive), None for open
+        :param until: datetime of the range end (exclusive), None for open
+        :param results: collection of result codes, None for all
+        :param after: position returned with a previous record to continue after it
+        :return: generator of (position, url, record)
+        """
+        conditions = list()
+        parameters = list()
+        if url is not None:
+            conditions.append('url = ?')
+            parameters.append(url)
+        if since is not None:
+            conditions.append('time >= ?')
+            parameters.append(self._time_key(since))
+        if until is not None:
+            conditions.append('time < ?')
+            parameters.append(self._time_key(until))
+        if results is not None:
+            conditions.append('result IN ({0})'.format(', '.join('?' * len(results))))
+            parameters.extend(results)
+        if after is not None:
+            conditions.append('(time > ? OR (time = ? AND id > ?))')
+            parameters.extend([after[0], after[0], after[1]])
+        sql = 'SELECT id, url, time, record FROM records'
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += ' ORDER BY time, id'
+        for row_id, row_url, time, record in self._select(sql, parameters):
+            yield [time, row_id], row_url, json.loads(record)
+
+    def read_rollups(self, period):
+        """
+        :param period: HOUR or DAY
+        :return: list of the rollups of the period, oldest first
+        """
+        with self.lock:
+            rows = self.db.execute('SELECT rollup FROM rollups WHERE period = ? ORDER BY time, url',
+                                   (period,)).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def append_run(self, summary):
+        """
+        Insert the summary of a run.
+        :param summary: dict of the run, see PmonRunStats.summary()
+        :return: None
+        """
+        with self.lock, self.db:
+            self.db.execute('INSERT INTO runs (time, run) VALUES (?, ?)',
+                            (summary['time'], json.dumps(summary, sort_keys=True)))
+
+    def read_runs(self, limit=None):
+        """
+        :param limit: maximum number of summaries, the newest ones; None for all
+        :return: list of the run summaries, oldest first
+        """
+        with self.lock:
+            rows = self.db.execute('SELECT run FROM runs ORDER BY id DESC LIMIT ?',
+                                   (limit if limit else -1,)).fetchall()
+        return [json.loads(row[0]) for row in reversed(rows)]
+
+    def compact(self, retention, now=None):
+        """
+        Enforce the retention tiers in one transaction. Expired raw
+        records are deleted and counted into the hourly rollups, the
+        rollups are condensed and dropped according to their tiers.
+        :param retention: the PmonRetention to apply
+        :param now: the current time, defaults to now
+        :return: number of raw records rolled up
+        """
+        if not retention.enabled():
+            return 0
+        now = now if now is not None else datetime.datetime.now()
+        cutoff = self._time_key(retention.raw_cutoff(now))
+        hourly = self.read_rollups(HOUR)
+        daily = self.read_rollups(DAY)
+        with self.lock, self.db:
+            rows = self.db.execute('SELECT url, record FROM records WHERE time < ?', (cutoff,))
+            expired = ((url, json.loads(record)) for url, record in rows)
+            hourly, daily = retention.roll(expired, hourly, daily, now)
+            rolled = self.db.execute('DELETE FROM records WHERE time < ?', (cutoff,)).rowcount
+            self.db.execute('DELETE FROM rollups')
+            self.db.executemany('INSERT INTO rollups (period, url, time, rollup) VALUES (?, ?, ?, ?)',
+                                [(r['period'], r['url'], r['time'], json.dumps(r, sort_keys=True))
+                                 for r in hourly + daily])
+        self.log.info('History compacted, {0} records rolled up'.format(rolled))
+        return rolled
+
+    def migrate(self, data_file):
+        """
+        One time import of a former 'data.file' holding the complete
+        history as a single JSON document.
+        :param data_file: name of the JSON file
+        :return: number of imported records
+        """
+        self.log.info('Migrating {0} into history {1}'.format(data_file, self.db_file))
+        records = read_data_file(data_file)
+        self.append(records)
+        self.log.info('Migrated {0} records'.format(len(records)))
+        return len(records)
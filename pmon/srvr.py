@@ -6,9 +6,20 @@
 # (c) ISC Clemenz & Weinbrecht GmbH 2018
 #
 
+import base64
+import binascii
+import datetime
+import hashlib
 import json
+import os
+import queue
+import threading
 
 import cherrypy
+from cherrypy.lib import cptools, httputil
+
+from pmon.scan_jobs import PmonScanJobs
+from pmon.sqlite_history import PmonSqliteHistory
 
 
 class PmonServer(object):
@@ -19,56 +30,383 @@ class PmonServer(object):
     log = None
     nomail_flag = False
     scan_callback = None
+    latest_lock = None
+    # cached response of index and the file state it was built from
+    latest_stat = None
+    latest_body = None
+    latest_etag = None
+    latest_modified = None
+    scan = None
+    history = None
+    events = None
+    metrics = None
 
-    def __init__(self, log, cfg, nomail_flag, scan_callback):
+    def __init__(self, log, cfg, nomail_flag, scan_callback, history=None, events=None, metrics=None):
         """
         Constructor.
         :param log: the logger
         :param cfg: the configuration
         :param nomail_flag: value of the nomail flag
-        :param scan_callback: callback function for forced scan
+        :param scan_callback: callback function(nomail_flag, progress) for forced scan
+        :param history: optional result history published under '/history'
+        :param events: optional PmonEvents streamed under '/events'
+        :param metrics: optional PmonMetrics published under '/metrics'
         """
         self.cfg = cfg
         self.log = log
         self.nomail_flag = nomail_flag
         self.scan_callback = scan_callback
+        self.latest_lock = threading.Lock()
+        if scan_callback is not None:
+            self.scan = PmonScanResource(log, nomail_flag, PmonScanJobs(log, scan_callback, self._scan_done))
+        if history is not None:
+            self.history = PmonHistoryResource(log, cfg, history)
+        if events is not None:
+            self.events = PmonEventsResource(log, events)
+        if metrics is not None:
+            self.metrics = PmonMetricsResource(metrics, self._refresh_metrics)
 
-    @cherrypy.expose
-    @cherrypy.tools.accept(media='application/json')
-    @cherrypy.tools.json_out()
-    def index(self):
+    def configure(self, cfg):
         """
-        Main data display content.
-        :return: JSON data reed from latest result file
+        Use a reloaded configuration.
+        :param cfg: the new configuration
+        :return: None
+        """
+        self.cfg = cfg
+        if self.history is not None:
+            self.history.cfg = cfg
+
+    def _latest(self, force=False):
+        """
+        Cached content of the latest result file. The file is only
+        read again if its state on disk changed.
+        :param force: reload even if the file seems unchanged
+        :return: (body, etag, modified) of the cached response
         """
         f_name = self.cfg['pmon']['latest.file']
         if f_name is None or f_name == '':
             raise cherrypy.HTTPError(500, 'Configuration error')
-        try:    
-            with open(f_name, 'r') as f:
-                data = json.load(f)
-            
-            result = {'id': self.cfg['pmon']['id'], 'data': data}
-            return result    
+        try:
+            st = os.stat(f_name)
         except FileNotFoundError:
             raise cherrypy.HTTPError(404)
+        stat = (st.st_ino, st.st_size, st.st_mtime_ns)
+        with self.latest_lock:
+            if force or stat != self.latest_stat:
+                try:
+                    with open(f_name, 'r') as f:
+                        data = json.load(f)
+                except FileNotFoundError:
+                    raise cherrypy.HTTPError(404)
+                if self.metrics is not None and isinstance(data, dict):
+                    # checks written by other processes, e.g. run by cron
+                    self.metrics.metrics.observe_latest(data)
+                result = {'id': self.cfg['pmon']['id'], 'data': data}
+                self.latest_body = json.dumps(result).encode('utf-8')
+                self.latest_etag = '"{0}"'.format(hashlib.sha1(self.latest_body).hexdigest())
+                self.latest_modified = st.st_mtime
+                self.latest_stat = stat
+                self.log.debug('Latest results reloaded')
+            return self.latest_body, self.latest_etag, self.latest_modified
+
+    @cherrypy.expose
+    @cherrypy.tools.accept(media='application/json')
+    def index(self):
+        """
+        Main data display content. Served from memory, answers
+        with 304 if the client already has the current state.
+        :return: JSON data reed from latest result file
+        """
+        body, etag, modified = self._latest()
+        headers = cherrypy.response.headers
+        headers['Content-Type'] = 'application/json'
+        headers['Cache-Control'] = 'no-cache'
+        headers['ETag'] = etag
+        headers['Last-Modified'] = httputil.HTTPDate(modified)
+        cptools.validate_etags()
+        cptools.validate_since()
+        return body
+
+    def _refresh_metrics(self):
+        """
+        Count the checks of the latest result file if it changed.
+        """
+        try:
+            self._latest()
+        except cherrypy.HTTPError:
+            pass
+
+    def _scan_done(self, job):
+        """
+        Refresh the cached latest results after a forced scan.
+        :param job: state of the finished job
+        """
+        try:
+            self._latest(force=True)
+        except cherrypy.HTTPError:
+            pass
+
+
+class PmonScanResource(object):
+    """
+    The '/scan' resource. Forced scans run in the background,
+    the requests only return the state of the job.
+    """
+    # answer '/scan' directly instead of redirecting to '/scan/'
+    _cp_config = {'tools.trailing_slash.missing': False}
+
+    log = None
+    nomail_flag = False
+    jobs = None
+
+    def __init__(self, log, nomail_flag, jobs):
+        """
+        Constructor.
+        :param log: the logger
+        :param nomail_flag: value of the nomail flag
+        :param jobs: the PmonScanJobs executing the scans
+        """
+        self.log = log
+        self.nomail_flag = nomail_flag
+        self.jobs = jobs
 
     @cherrypy.expose
     @cherrypy.tools.accept(media='application/json')
     @cherrypy.tools.json_out()
-    def scan(self, notify=False):
+    def index(self, notify=False):
         """
-        Triggers rescan of process data.
+        Triggers rescan of process data, joins a scan already in flight.
         :param notify: value for the nomail flag given by web-user
-        :return: same as index(self)
+        :return: state of the scan job
         """
         self.log.debug('Forced scan: {0}'.format(notify))
-        if self.scan_callback is None:
-            raise cherrypy.HTTPError(404)
-
         local_nomail_flag = self.nomail_flag
         if notify is not None:
             local_nomail_flag = not (notify == 'True')
 
-        self.scan_callback(local_nomail_flag)
-        return self.index()
+        return self.jobs.request(local_nomail_flag)
+
+    @cherrypy.expose
+    @cherrypy.tools.accept(media='application/json')
+    @cherrypy.tools.json_out()
+    def status(self, job=None):
+        """
+        Progress of a scan job.
+        :param job: id of the job, the most recent one if not given
+        :return: state of the scan job
+        """
+        state = self.jobs.status(job)
+        if state is None:
+            raise cherrypy.HTTPError(404)
+        return state
+
+
+class PmonHistoryResource(object):
+    """
+    The '/history' resource. Pages of past records are read through
+    the index of the history and streamed to the client record by
+    record, a cursor in the response continues with the next page.
+    """
+    _cp_config = {'tools.trailing_slash.missing': False}
+
+    DEFAULT_LIMIT = 100
+    MAX_LIMIT = 1000
+
+    log = None
+    cfg = None
+    history = None
+
+    def __init__(self, log, cfg, history):
+        """
+        Constructor.
+        :param log: the logger
+        :param cfg: the configuration
+        :param history: the PmonHistory or PmonSqliteHistory to read from
+        """
+        self.log = log
+        self.cfg = cfg
+        self.history = history
+
+    @staticmethod
+    def _time(name, value):
+        if value is None or value == '':
+            return None
+        try:
+            time = datetime.datetime.fromisoformat(value)
+        except ValueError:
+            raise cherrypy.HTTPError(400, 'Invalid {0}: {1}'.format(name, value))
+        if time.tzinfo is not None:
+            # records are stamped in local time without offset
+            time = time.astimezone().replace(tzinfo=None)
+        return time
+
+    @staticmethod
+    def _encode_cursor(position):
+        return base64.urlsafe_b64encode(json.dumps(position).encode('utf-8')).decode('ascii')
+
+    def _decode_cursor(self, cursor):
+        """
+        :param cursor: cursor of a previous page
+        :return: the position of the history, [time, id] for SQLite, otherwise two numbers
+        """
+        if cursor is None or cursor == '':
+            return None
+        try:
+            position = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        except (ValueError, binascii.Error, UnicodeError):
+            raise cherrypy.HTTPError(400, 'Invalid cursor')
+        if not isinstance(position, list) or len(position) != 2:
+            raise cherrypy.HTTPError(400, 'Invalid cursor')
+        # checked before streaming, a failing query would cut the response off
+        first = str if isinstance(self.history, PmonSqliteHistory) else int
+        if any(not isinstance(v, t) or isinstance(v, bool) for v, t in zip(position, (first, int))):
+            raise cherrypy.HTTPError(400, 'Invalid cursor')
+        return position
+
+    def _stream(self, records, limit):
+        """
+        Write the page as JSON, one record at a time.
+        :param records: generator of (position, url, record)
+        :param limit: maximum number of records in the page
+        :return: generator of the encoded response
+        """
+        yield '{{"id": {0}, "records": ['.format(json.dumps(self.cfg['pmon']['id'])).encode('utf-8')
+        count = 0
+        position = None
+        cursor = None
+        for next_position, url, record in records:
+            if count == limit:
+                # there is at least one more record
+                cursor = self._encode_cursor(position)
+                break
+            line = dict(record)
+            line['url'] = url
+            yield ((', ' if count else '') + json.dumps(line, sort_keys=True, default=str)).encode('utf-8')
+            count += 1
+            position = next_position
+        records.close()
+        yield '], "cursor": {0}}}'.format(json.dumps(cursor)).encode('utf-8')
+
+    @cherrypy.expose
+    @cherrypy.tools.accept(media='application/json')
+    @cherrypy.config(**{'response.stream': True})
+    def index(self, target=None, since=None, until=None, result=None, limit=None, cursor=None):
+        """
+        Past records of all or one target, oldest first.
+        :param target: url or config-key of a target, e.g. 'url.4', all if not given
+        :param since: ISO time of the range start (inclusive)
+        :param until: ISO time of the range end (exclusive)
+        :param result: comma separated result codes to select
+        :param limit: maximum number of records in the page, default 100
+        :param cursor: cursor of the previous page
+        :return: JSON with the records and the cursor of the next page, null on the last page
+        """
+        url = None
+        if target is not None and target != '':
+            url = self.cfg['urls'].get(target, target) if target.startswith('url.') else target
+        results = None
+        if result is not None and result != '':
+            results = [r.strip() for r in result.split(',') if r.strip()]
+        try:
+            limit = self.DEFAULT_LIMIT if limit is None or limit == '' else int(limit)
+        except ValueError:
+            raise cherrypy.HTTPError(400, 'Invalid limit: {0}'.format(limit))
+        limit = max(1, min(limit, self.MAX_LIMIT))
+
+        records = self.history.find(url,
+                                    self._time('since', since),
+                                    self._time('until', until),
+                                    results,
+                                    self._decode_cursor(cursor))
+        self.log.debug('History query: {0} {1} {2} {3}'.format(url, since, until, results))
+        cherrypy.response.headers['Content-Type'] = 'application/json'
+        return self._stream(records, limit)
+
+
+class PmonEventsResource(object):
+    """
+    The '/events' resource. Streams every finished check to the
+    client as Server-Sent Event, the UI updates the row of the
+    target instead of polling the complete results. Every client
+    occupies a server thread while connected.
+    """
+    _cp_config = {'tools.trailing_slash.missing': False}
+
+    # seconds between comments keeping idle connections open
+    KEEPALIVE = 15
+
+    log = None
+    events = None
+
+    def __init__(self, log, events):
+        """
+        Constructor.
+        :param log: the logger
+        :param events: the PmonEvents to subscribe to
+        """
+        self.log = log
+        self.events = events
+
+    def _stream(self, subscriber):
+        try:
+            yield b'retry: 5000\n\n'
+            while True:
+                try:
+                    event = subscriber.get(timeout=self.KEEPALIVE)
+                except queue.Empty:
+                    yield b': keep-alive\n\n'
+                    continue
+                if event is None:
+                    return
+                yield 'id: {0}\ndata: {1}\n\n'.format(event[0], event[1]).encode('utf-8')
+        finally:
+            self.events.unsubscribe(subscriber)
+
+    @cherrypy.expose
+    @cherrypy.config(**{'response.stream': True})
+    def index(self):
+        """
+        Event stream of the check results, each event holds url and record.
+        :return: the stream, continues after the Last-Event-ID of a reconnecting client
+        """
+        last_id = cherrypy.request.headers.get('Last-Event-ID')
+        try:
+            last_id = int(last_id) if last_id else None
+        except ValueError:
+            last_id = None
+        subscriber = self.events.subscribe(last_id)
+        if subscriber is None:
+            raise cherrypy.HTTPError(503, 'Too many event clients')
+        headers = cherrypy.response.headers
+        headers['Content-Type'] = 'text/event-stream'
+        headers['Cache-Control'] = 'no-cache'
+        return self._stream(subscriber)
+
+
+class PmonMetricsResource(object):
+    """
+    The '/metrics' resource for scraping by Prometheus.
+    """
+    _cp_config = {'tools.trailing_slash.missing': False}
+
+    metrics = None
+    refresh = None
+
+    def __init__(self, metrics, refresh=None):
+        """
+        Constructor.
+        :param metrics: the PmonMetrics to publish
+        :param refresh: optional callable counting the checks finished elsewhere
+        """
+        self.metrics = metrics
+        self.refresh = refresh
+
+    @cherrypy.expose
+    def index(self):
+        """
+        :return: the metrics in the Prometheus text format
+        """
+        if self.refresh is not None:
+            self.refresh()
+        cherrypy.response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+        return self.metrics.render().encode('utf-8')
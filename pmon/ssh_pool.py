@@ -0,0 +1,145 @@
+#
+# -*- coding: utf-8-*-
+# Pool of authenticated SSH connections on top of paramiko.
+#
+# (c) ISC Clemenz & Weinbrecht GmbH 2018
+#
+
+import threading
+import time
+
+from paramiko import client
+
+
+class PmonSshPool(object):
+    """
+    Keeps authenticated SSH clients keyed by host, user and port, so the
+    key exchange and login are done once per host and not for every
+    sensor. A client is shared by all borrowers, paramiko multiplexes
+    their commands as channels of the one transport. Clients unused
+    for longer than the idle timeout are closed, dead ones are
+    replaced on the next acquire.
+    Cleanup requires call to 'close()'
+    """
+    log = None
+    idle_timeout = 0
+    lock = None
+    entries = None
+    connect_locks = None
+
+    def __init__(self, log, idle_timeout):
+        """
+        Constructor.
+        :param log: the logger
+        :param idle_timeout: seconds after which an unused connection is closed
+        """
+        self.log = log
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        self.entries = dict()
+        self.connect_locks = dict()
+
+    @staticmethod
+    def _alive(clnt):
+        """
+        :param clnt: a paramiko SSHClient
+        :return: True if the transport of the client is still usable
+        """
+        transport = clnt.get_transport()
+        if transport is None or not transport.is_active():
+            return False
+        try:
+            transport.send_ignore()
+            return True
+        except Exception:
+            return False
+
+    def _connect(self, host, user, pwd, port):
+        clnt = client.SSHClient()
+        clnt.load_system_host_keys()
+        clnt.set_missing_host_key_policy(client.AutoAddPolicy())
+        clnt.connect(host,
+                     port=port,
+                     username=user,
+                     password=pwd,
+                     look_for_keys=False)
+        self.log.debug("SSH pool connected: {0}@{1}".format(user, host))
+        return clnt
+
+    def acquire(self, host, user, pwd, port=22):
+        """
+        Borrow a connected client, connects if there is no usable one.
+        :param host: the remote host
+        :param user: the remote user
+        :param pwd: the password of the user
+        :param port: the SSH port of the host
+        :return: a connected paramiko SSHClient, give back with release()
+        """
+        self.evict_idle()
+        key = (host, user, port)
+        with self.lock:
+            connect_lock = self.connect_locks.setdefault(key, threading.Lock())
+
+        # connecting is slow, only block borrowers of the same key
+        with connect_lock:
+            with self.lock:
+                entry = self.entries.get(key)
+            if entry is not None and not self._alive(entry['client']):
+                self.log.info("SSH pool drops dead connection: {0}@{1}".format(user, host))
+                with self.lock:
+                    if self.entries.get(key) is entry:
+                        del self.entries[key]
+                if entry['users'] == 0:
+                    entry['client'].close()
+                entry = None
+            if entry is None:
+                entry = {'client': self._connect(host, user, pwd, port), 'users': 0, 'last_used': time.monotonic()}
+                with self.lock:
+                    self.entries[key] = entry
+            with self.lock:
+                entry['users'] += 1
+                entry['last_used'] = time.monotonic()
+            return entry['client']
+
+    def release(self, clnt):
+        """
+        Give back a borrowed client, it stays open for reuse.
+        :param clnt: the client returned by acquire()
+        :return: None
+        """
+        with self.lock:
+            for entry in self.entries.values():
+                if entry['client'] is clnt:
+                    entry['users'] -= 1
+                    entry['last_used'] = time.monotonic()
+                    return
+        # no longer pooled, it has been replaced in the meantime
+        clnt.close()
+
+    def evict_idle(self):
+        """
+        Close connections unused for longer than the idle timeout.
+        :return: None
+        """
+        now = time.monotonic()
+        idle = list()
+        with self.lock:
+            for key, entry in list(self.entries.items()):
+                if entry['users'] == 0 and now - entry['last_used'] > self.idle_timeout:
+                    idle.append((key, entry['client']))
+                    del self.entries[key]
+        for key, clnt in idle:
+            self.log.debug("SSH pool closes idle connection: {0[1]}@{0[0]}".format(key))
+            clnt.close()
+
+    def close(self):
+        """
+        Close all pooled connections.
+        :return: None
+        """
+        with self.lock:
+            clients = [entry['client'] for entry in self.entries.values()]
+            self.entries.clear()
+        for clnt in clients:
+            clnt.close()
+        self.log.debug("SSH pool closed")
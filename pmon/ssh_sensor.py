@@ -4,7 +4,12 @@
 #
 # (c) ISC Clemenz & Weinbrecht GmbH 2018
 #
-import urllib.parse
+import json
+import os
+import select
+import shlex
+import threading
+import uuid
 
 from paramiko import client
 
@@ -12,21 +17,24 @@ from paramiko import client
 class PmonSensor(object):
 
     @staticmethod
-    def all_sensors(log, cfg, url_key, record):
+    def all_sensors(log, cfg, target, record):
         """
         Perform all scans at once
         :param log: the logger
         :param cfg:  current configuration
-        :param url_key: config-key
+        :param target: the PmonTarget
         :param record: data container
         :return: None
         """
         try:
-            with PmonSensor(log, cfg, url_key, record) as sensor:
-                sensor.scan_cmd()
-                sensor.df_size()
-                sensor.mem()
-                sensor.scan_logs()
+            with PmonSensor(log, cfg, target, record) as sensor:
+                if cfg.has_section('pmon') and cfg['pmon'].getboolean('ssh.batch', fallback=False):
+                    sensor.batch_sensors()
+                else:
+                    sensor.scan_cmd()
+                    sensor.df_size()
+                    sensor.mem()
+                    sensor.scan_logs()
         except Exception as x:
             log.error("All ssh-sensors: " + str(x))
 
@@ -36,22 +44,52 @@ class PmonSensor(object):
     """
     log = None
     cfg = None
-    url_key = None
+    target = None
+    remote = None
     clnt = None
     record = None
+    # optional PmonSshPool shared by all sensors
+    pool = None
+    pooled = False
+    host = None
+    BUFFER_SIZE = 32768
+    # guards the file with the offsets of the scanned remote logs
+    log_state_lock = threading.Lock()
+    log_marker = None
+    log_state_key = None
+    LOG_SCRIPT = ('for f in {log_dir}/{log_files}; do\n'
+                  '  [ -f "$f" ] || continue\n'
+                  '  set -- $(stat -L -c \'%i %s\' "$f")\n'
+                  '  ino=$1; size=$2; off=0; sig=\n'
+                  '  case "$ino" in\n'
+                  '{cases}'
+                  '  esac\n'
+                  '  [ "$size" -lt "$off" ] && off=0\n'
+                  '  n=$off; [ "$n" -gt 256 ] && n=256\n'
+                  '  [ "$off" -gt 0 ] && [ "$(head -c $n "$f" | cksum | cut -d \' \' -f 1)" != "$sig" ] && off=0\n'
+                  '  n=$size; [ "$n" -gt 256 ] && n=256\n'
+                  '  echo "{marker} $ino $size $(head -c $n "$f" | cksum | cut -d \' \' -f 1) $f"\n'
+                  '  tail -c +$((off + 1)) "$f" | head -c $((size - off)) | grep -i -- {pattern}\n'
+                  'done')
+    TRUNCATED = '[... output truncated at {0} bytes]'
+    output_max = 1024 * 1024
+    command_timeout = 60
 
-    def __init__(self, log, cfg, url_key, record):
+    def __init__(self, log, cfg, target, record):
         """
         Constructor.
         :param log: the logger
         :param cfg: configuration data
-        :param url_key: which url to use from configuration
+        :param target: the PmonTarget to scan the remote machine of
         :param record: data container
         """
         self.cfg = cfg
         self.log = log
-        self.url_key = url_key
+        self.target = target
+        self.remote = target.remote
         self.record = record
+        self.output_max = cfg.getint('pmon', 'ssh.output.max', fallback=PmonSensor.output_max)
+        self.command_timeout = cfg.getint('pmon', 'ssh.command.timeout', fallback=PmonSensor.command_timeout)
 
     def __enter__(self):
         """
@@ -98,47 +136,80 @@ class PmonSensor(object):
         if not self.__check() or self.clnt is not None:
             return False
 
-        url = self.cfg['urls'][self.url_key]
-        parsed = urllib.parse.urlparse(url)
-        host = parsed.netloc
+        host = self.remote.host
+        port = self.remote.port
+        self.host = host
+        user = self.remote.user
+        pwd = self.remote.pwd
+        if PmonSensor.pool is not None:
+            self.clnt = PmonSensor.pool.acquire(host, user, pwd, port)
+            self.pooled = True
+            self.log.debug("SSH sensor uses pooled connection: {0}".format(host))
+            return True
+
         self.clnt = client.SSHClient()
         self.clnt.load_system_host_keys()
         self.clnt.set_missing_host_key_policy(client.AutoAddPolicy())
         self.clnt.connect(host,
-                          username=self.cfg['remote'][self.url_key + '.user'],
-                          password=self.cfg['remote'][self.url_key + '.pwd'],
+                          port=port,
+                          username=user,
+                          password=pwd,
                           look_for_keys=False)
         self.log.debug("SSH sensor connected: {0}".format(host))
         return True
 
     def close(self):
         if self.clnt is not None:
-            self.clnt.close()
+            if self.pooled:
+                PmonSensor.pool.release(self.clnt)
+                self.pooled = False
+            else:
+                self.clnt.close()
             self.clnt = None
             self.log.debug("SSH sensor connection closed")
 
-    def __ssh_command(self, command):
+    def __ssh_lines(self, command):
         """
-        Execute a command on remote machine.
+        Execute a command on remote machine and deliver its output
+        line by line as it arrives. Waits on the channel with select,
+        stderr is drained and dropped.
 
         :param command: the command to issue
-        :return: output of the command
+        :return: generator of the output lines as bytes without line end
         """
+        stdin, stdout, stderr = self.clnt.exec_command(command)
+        channel = stdout.channel
+        try:
+            pending = bytearray()
+            while True:
+                ready, _, _ = select.select([channel], [], [], self.command_timeout)
+                if not ready:
+                    raise Exception('Timeout executing: {0}'.format(command))
+                while channel.recv_stderr_ready():
+                    channel.recv_stderr(self.BUFFER_SIZE)
+                data = channel.recv(self.BUFFER_SIZE)
+                if not data:
+                    break
+                pending.extend(data)
+                if b'\n' in data:
+                    lines = pending.split(b'\n')
+                    pending = lines.pop()
+                    for line in lines:
+                        yield bytes(line)
+            if pending:
+                yield bytes(pending)
+        finally:
+            channel.close()
 
-        def __read_stream(stream):
-            while not stream.channel.exit_status_ready():
-                if stream.channel.recv_ready():
-                    all_data_buffer = stream.channel.recv(1024)
-                    prev_data = b"1"
-                    while prev_data:
-                        prev_data = stream.channel.recv(1024)
-                        all_data_buffer += prev_data
-
-                    if all_data_buffer is not None:
-                        all_data_buffer = all_data_buffer.decode('utf-8').strip()
-
-                    return all_data_buffer
+    def __ssh_command(self, command, line_filter=None):
+        """
+        Execute a command on remote machine. The output is capped at
+        'ssh.output.max' bytes, a marker line shows the truncation.
 
+        :param command: the command to issue
+        :param line_filter: optional predicate, only lines passing it are kept
+        :return: output of the command
+        """
         if not self.clnt:
             self.log.error('Not connected')
             self.__add_to_ssh_message('Not connected')
@@ -146,8 +217,22 @@ class PmonSensor(object):
 
         self.log.debug("Executing command: {0}".format(command))
         try:
-            stdin, stdout, stderr = self.clnt.exec_command(command)
-            all_data = __read_stream(stdout)
+            kept = list()
+            size = 0
+            lines = self.__ssh_lines(command)
+            try:
+                for raw in lines:
+                    line = raw.decode('utf-8', errors='replace')
+                    if line_filter is not None and not line_filter(line):
+                        continue
+                    size += len(raw) + 1
+                    if size > self.output_max:
+                        kept.append(self.TRUNCATED.format(self.output_max))
+                        break
+                    kept.append(line)
+            finally:
+                lines.close()
+            all_data = '\n'.join(kept).strip()
 
             self.log.debug(all_data)
             return all_data
@@ -160,18 +245,18 @@ class PmonSensor(object):
         Check if a SSH connection is set
         :return: True if connection type is SSH, otherwise False
         """
-        self.log.info("check before " + self.url_key)
+        self.log.info("check before " + self.target.key)
 
         # Connection type
-        if (self.url_key + '.type') in self.cfg['remote']:
-            con_type = self.cfg['remote'][self.url_key + '.type']
+        if self.remote is not None:
+            con_type = self.remote.type
             if con_type == 'ssh':
                 return True
             else:
                 self.log.info('Unsupported connection type: ' + con_type)
                 return False
         else:
-            self.log.warning('No type entry: ' + self.url_key)
+            self.log.warning('No type entry: ' + self.target.key)
             return False
 
     def df_size(self):
@@ -196,12 +281,23 @@ class PmonSensor(object):
         Scan for the configured process marker with configured command
         :return:
         """
-        process = self.cfg['remote'][self.url_key + '.process']
+        process = self.remote.process
         if process is None or process == '':
-            self.log.warn('No process defined to scan for: ' + self.url_key)
+            self.log.warn('No process defined to scan for: ' + self.target.key)
             self.__add_to_ssh_message('no process marker configured')
             return
-        result = self.__ssh_command(self.cfg['remote'][self.url_key + '.scan_cmd'])
+        # only the matching lines of the process list are kept
+        result = self.__ssh_command(self.remote.scan_cmd,
+                                    line_filter=lambda l: l.find(process, 0) >= 0)
+        self.__find_process(result, process)
+
+    def __find_process(self, result, process):
+        """
+        Keep the lines of a process list containing the process marker.
+        :param result: output of the scan command
+        :param process: the process marker
+        :return:
+        """
         if result is not None:
             # log.debug('Result: {0}'.format(result))
             lns = result.split('\n')
@@ -211,7 +307,7 @@ class PmonSensor(object):
                     fnd.append(l)
             self.record['ssh'] = fnd
             if len(fnd) > 0:
-                self.log.info("found process entries for: " + self.url_key)
+                self.log.info("found process entries for: " + self.target.key)
             else:
                 self.log.debug('No matching process found')
                 self.__add_to_ssh_message('Process marker not found on remote machine')
@@ -220,13 +316,13 @@ class PmonSensor(object):
             self.__add_to_ssh_message('no ps result at all')
 
     def scan_mysql(self):
-        command = self.cfg['remote'][self.url_key + '.scan_cmd']
+        command = self.remote.scan_cmd
         if command is None or command == '':
-            self.log.warn('No scan_cmd defined to scan for: ' + self.url_key)
+            self.log.warn('No scan_cmd defined to scan for: ' + self.target.key)
             self.__add_to_ssh_message('no scan_cmd configured')
             return
         self.log.info("Executing configured command")
-        result = self.__ssh_command(self.cfg['remote'][self.url_key + '.scan_cmd'])
+        result = self.__ssh_command(command)
         if 'mysqld is alive' in result:
             self.log.info("Check succeeded")
             self.record['result'] = 'SUCCESS'
@@ -237,22 +333,22 @@ class PmonSensor(object):
             self.record['message'] = result
 
     def _scan_core(self):
-        command = self.cfg['remote'][self.url_key + '.scan_cmd']
+        command = self.remote.scan_cmd
         if command is None or command == '':
-            self.log.warn('No scan_cmd defined to scan for: ' + self.url_key)
+            self.log.warn('No scan_cmd defined to scan for: ' + self.target.key)
             self.__add_to_ssh_message('no scan_cmd configured')
             return
         self.log.debug("Executing configured command")
-        return self.__ssh_command(self.cfg['remote'][self.url_key + '.scan_cmd'])
+        return self.__ssh_command(command)
 
     def scan_ps(self):
-        command = self.cfg['remote'][self.url_key + '.scan_cmd']
+        command = self.remote.scan_cmd
         if command is None or command == '':
-            self.log.warn('No scan_cmd defined to scan for: ' + self.url_key)
+            self.log.warn('No scan_cmd defined to scan for: ' + self.target.key)
             self.__add_to_ssh_message('no scan_cmd configured')
             return
         self.log.info("Executing configured command")
-        result = self.__ssh_command(self.cfg['remote'][self.url_key + '.scan_cmd'])
+        result = self.__ssh_command(command)
         if 'mysqld is alive' in result:
             self.log.info("Check succeeded")
             self.record['result'] = 'SUCCESS'
@@ -268,13 +364,202 @@ class PmonSensor(object):
         :return:
         """
         self.log.debug('Scan log files')
-        pattern = self.cfg['remote'][self.url_key + '.log.pattern']
-        log_dir = self.cfg['remote'][self.url_key + '.log.dir']
-        log_files = self.cfg['remote'][self.url_key + '.log.files']
+        cmd = self.__log_command()
+        if cmd is None:
+            return
+        grep = self.__ssh_command(cmd)
+        self.__apply_logs(grep)
+
+    def __log_command(self):
+        """
+        The command scanning the configured logs. In incremental mode
+        a script greps only the bytes appended to each file since the
+        last scan. Files are identified by inode, a rotated file keeps
+        its offset. A new file, or one that got truncated or whose
+        first bytes changed, is scanned from the start.
+        :return: the command, None if not configured
+        """
+        pattern = self.remote.log_pattern
+        log_dir = self.remote.log_dir
+        log_files = self.remote.log_files
         if pattern is None or log_dir is None or log_files is None:
             self.log.info('No log file scan configured or incomplete')
             self.__add_to_ssh_message('No log file scan configured or incomplete')
+            return None
+        if not self.cfg.getboolean('pmon', 'ssh.log.incremental', fallback=True):
+            return 'grep -i "{0}" {1}/{2}'.format(pattern, log_dir, log_files)
+
+        self.log_state_key = '{0}@{1}:{2}/{3}'.format(self.remote.user, self.host, log_dir, log_files)
+        self.log_marker = '@@PMON-FILE-' + uuid.uuid4().hex
+        offsets = self.__load_log_offsets()
+        cases = ''.join('    {0}) off={1}; sig={2} ;;\n'.format(int(ino), int(off), int(sig))
+                        for ino, (off, sig) in offsets.items())
+        return self.LOG_SCRIPT.format(log_dir=log_dir,
+                                      log_files=log_files,
+                                      cases=cases,
+                                      marker=self.log_marker,
+                                      pattern=shlex.quote(pattern))
+
+    def __apply_logs(self, output):
+        """
+        Store the log matches in the record. In incremental mode the
+        matches are prefixed with their file name and the new offsets
+        are persisted.
+        :param output: output of the log command
+        :return:
+        """
+        if self.log_marker is None or output is None:
+            self.record['logs'] = output
             return
-        cmd = 'grep -i "{0}" {1}/{2}'.format(pattern, log_dir, log_files)
-        grep = self.__ssh_command(cmd)
-        self.record['logs'] = grep
+        offsets = dict()
+        matches = list()
+        path = None
+        for line in output.split('\n'):
+            if line.startswith(self.log_marker + ' '):
+                ino, size, sig, path = line[len(self.log_marker) + 1:].split(' ', 3)
+                offsets[ino] = [int(size), int(sig)]
+            elif path is not None and line != '':
+                matches.append(path + ':' + line)
+        # a truncated output misses files, they keep their offsets
+        truncated = len(matches) > 0 and matches[-1].endswith(self.TRUNCATED.format(self.output_max))
+        self.__save_log_offsets(offsets, truncated)
+        self.record['logs'] = '\n'.join(matches)
+
+    def __log_state_file(self):
+        """
+        :return: name of the local file with the offsets of the scanned logs
+        """
+        name = self.cfg.get('pmon', 'ssh.log.state', fallback=None)
+        if name is None:
+            data_file = self.cfg.get('pmon', 'data.file', fallback='pmon.json')
+            name = os.path.splitext(data_file)[0] + '.logstate.json'
+        return name
+
+    def __read_log_state(self):
+        name = self.__log_state_file()
+        if not os.path.isfile(name):
+            return dict()
+        try:
+            with open(name, 'r') as f:
+                return json.load(f)
+        except Exception as x:
+            self.log.error('Unreadable log state {0}: {1}'.format(name, str(x)))
+            return dict()
+
+    def __load_log_offsets(self):
+        """
+        :return: dictionary of inode to [offset, checksum of the first bytes] of the last scan
+        """
+        with PmonSensor.log_state_lock:
+            return self.__read_log_state().get(self.log_state_key, dict())
+
+    def __save_log_offsets(self, offsets, keep_missing):
+        """
+        Persist the offsets of the scanned logs.
+        :param offsets: dictionary of inode to [offset, checksum of the first bytes]
+        :param keep_missing: keep the offsets of files not in offsets
+        :return:
+        """
+        name = self.__log_state_file()
+        with PmonSensor.log_state_lock:
+            state = self.__read_log_state()
+            if keep_missing:
+                merged = state.get(self.log_state_key, dict())
+                merged.update(offsets)
+                offsets = merged
+            state[self.log_state_key] = offsets
+            try:
+                with open(name + '.tmp', 'w') as f:
+                    json.dump(state, f, indent=2, sort_keys=True)
+                os.replace(name + '.tmp', name)
+            except Exception as x:
+                self.log.error('Log state not saved {0}: {1}'.format(name, str(x)))
+
+    def batch_sensors(self):
+        """
+        Same as scan_cmd, df_size, mem and scan_logs, but all commands
+        are sent as one remote script. The output of each command is
+        framed by a marker line and parsed back into the record while
+        it arrives, only the matching lines of the process list are kept.
+        :return:
+        """
+        probes = list()
+        process = self.remote.process
+        if process is None or process == '':
+            self.log.warn('No process defined to scan for: ' + self.target.key)
+            self.__add_to_ssh_message('no process marker configured')
+        else:
+            probes.append(('ssh', self.remote.scan_cmd))
+        probes.append(('file.system', 'df'))
+        probes.append(('memory', "egrep 'Mem|Cache|Swap' /proc/meminfo"))
+        log_cmd = self.__log_command()
+        if log_cmd is not None:
+            probes.append(('logs', log_cmd))
+
+        marker = '@@PMON-' + uuid.uuid4().hex
+        script = '\n'.join("echo '{0} {1}'\n{2}".format(marker, field, cmd) for field, cmd in probes)
+        sections = self.__ssh_sections(script,
+                                       marker,
+                                       {'ssh': lambda l: l.find(process, 0) >= 0})
+        if sections is None:
+            sections = dict()
+        for field, cmd in probes:
+            if field == 'ssh':
+                self.__find_process(sections.get(field), process)
+            elif field == 'logs':
+                self.__apply_logs(sections.get(field))
+            else:
+                self.record[field] = sections.get(field)
+
+    def __ssh_sections(self, command, marker, line_filters):
+        """
+        Execute a batch script on remote machine and split its output
+        at the marker lines as it arrives. Each section is filtered and
+        capped at 'ssh.output.max' bytes on its own, a marker line
+        shows the truncation.
+
+        :param command: the script to issue
+        :param marker: the marker starting a section line
+        :param line_filters: dictionary of section name to a predicate, only lines passing it are kept
+        :return: dictionary of section name to its stripped output, None on failure
+        """
+        if not self.clnt:
+            self.log.error('Not connected')
+            self.__add_to_ssh_message('Not connected')
+            return None
+
+        self.log.debug("Executing command: {0}".format(command))
+        try:
+            sections = dict()
+            kept = None
+            line_filter = None
+            size = 0
+            lines = self.__ssh_lines(command)
+            try:
+                for raw in lines:
+                    line = raw.decode('utf-8', errors='replace')
+                    if line.startswith(marker + ' '):
+                        name = line[len(marker) + 1:].strip()
+                        kept = sections.setdefault(name, list())
+                        line_filter = line_filters.get(name)
+                        size = 0
+                        continue
+                    if kept is None or size > self.output_max:
+                        continue
+                    if line_filter is not None and not line_filter(line):
+                        continue
+                    size += len(raw) + 1
+                    if size > self.output_max:
+                        kept.append(self.TRUNCATED.format(self.output_max))
+                        continue
+                    kept.append(line)
+            finally:
+                lines.close()
+            sections = {name: '\n'.join(kept).strip() for name, kept in sections.items()}
+
+            self.log.debug(sections)
+            return sections
+        except Exception as x:
+            self.log.error(str(x))
+            self.__add_to_ssh_message(str(x))
+            return None
@@ -0,0 +1,144 @@
+#
+# -*- coding: utf-8-*-
+# The targets of the configuration, compiled once.
+#
+# (c) ISC Clemenz & Weinbrecht GmbH 2018
+#
+
+import urllib.parse
+
+# scheme of the url -> protocol of the check
+PROTOCOLS = {'http': 'http',
+             'https': 'http',
+             'mysql': 'mysql',
+             'ssh': 'ssh'}
+
+
+class PmonRemote(object):
+    """
+    Access to the machine of a target for the SSH sensors, from the
+    entries url.XX.* of the section 'remote'.
+    """
+    __slots__ = ('type', 'host', 'port', 'user', 'pwd', 'process', 'scan_cmd',
+                 'log_dir', 'log_files', 'log_pattern')
+
+    def __init__(self, cfg_name, host, section):
+        """
+        Constructor.
+        :param cfg_name: config-key of the target
+        :param host: host of the target
+        :param section: the section 'remote'
+        """
+        def option(name):
+            return section.get(cfg_name + '.' + name)
+
+        self.type = option('type')
+        self.host = host
+        try:
+            self.port = section.getint(cfg_name + '.port', fallback=22)
+        except ValueError:
+            raise Exception('Invalid port of {0}: {1}'.format(cfg_name, option('port')))
+        self.user = option('user')
+        self.pwd = option('pwd')
+        self.process = option('process')
+        self.scan_cmd = option('scan_cmd')
+        self.log_dir = option('log.dir')
+        self.log_files = option('log.files')
+        self.log_pattern = option('log.pattern')
+        if self.type == 'ssh' and (not self.user or self.pwd is None):
+            raise Exception('Missing user or pwd of remote {0}'.format(cfg_name))
+
+
+class PmonTarget(object):
+    """
+    A configured target with everything a check needs, so checks do
+    no lookups in the configuration.
+    """
+    __slots__ = ('key', 'url', 'protocol', 'host', 'interval', 'jitter', 'remote')
+
+    def __init__(self, cfg_name, url, interval, jitter, remote_section=None):
+        """
+        Constructor.
+        :param cfg_name: config-key of the target, e.g. 'url.4'
+        :param url: the url to check
+        :param interval: seconds between two checks in daemon mode
+        :param jitter: maximum random deviation from the interval in seconds
+        :param remote_section: the section 'remote' if configured
+        """
+        parsed = urllib.parse.urlparse(url)
+        if parsed.scheme not in PROTOCOLS:
+            raise Exception('Unsupported url of {0}: {1}'.format(cfg_name, url))
+        self.key = cfg_name
+        self.url = url
+        self.protocol = PROTOCOLS[parsed.scheme]
+        # the port of the url belongs to the checked service, not to SSH
+        self.host = parsed.hostname if parsed.hostname else parsed.netloc
+        self.interval = interval
+        self.jitter = jitter
+        self.remote = None
+        if remote_section is not None and (cfg_name + '.type') in remote_section:
+            self.remote = PmonRemote(cfg_name, self.host, remote_section)
+
+
+class PmonTargets(object):
+    """
+    All targets of a configuration in config order. Never changed
+    after loading, a new configuration yields new PmonTargets.
+    """
+    __slots__ = ('targets', 'by_key', 'by_url')
+
+    def __init__(self, targets):
+        """
+        Constructor.
+        :param targets: list of PmonTarget
+        """
+        self.targets = tuple(targets)
+        self.by_key = {t.key: t for t in self.targets}
+        self.by_url = {t.url: t for t in self.targets}
+
+    def __len__(self):
+        return len(self.targets)
+
+    def __iter__(self):
+        return iter(self.targets)
+
+    def get(self, cfg_name):
+        """
+        :param cfg_name: config-key of a target
+        :return: the PmonTarget, None if not configured
+        """
+        return self.by_key.get(cfg_name)
+
+    def resolve(self, target):
+        """
+        :param target: the url or its config-key, e.g. 'url.4'
+        :return: the url
+        """
+        if target.startswith('url.') and target in self.by_key:
+            return self.by_key[target].url
+        return target
+
+
+def load_targets(cfg):
+    """
+    Compile and validate the targets of a configuration.
+    :param cfg: the configuration
+    :return: PmonTargets
+    """
+    interval = cfg.getint('schedule', 'interval', fallback=300)
+    jitter = cfg.getint('schedule', 'jitter', fallback=10)
+    remote = cfg['remote'] if cfg.has_section('remote') else None
+    targets = list()
+    if cfg.has_section('urls'):
+        for cfg_name, url in cfg['urls'].items():
+            if not cfg_name.startswith('url.'):
+                continue
+            try:
+                targets.append(PmonTarget(cfg_name,
+                                          url,
+                                          cfg.getint('schedule', cfg_name + '.interval', fallback=interval),
+                                          cfg.getint('schedule', cfg_name + '.jitter', fallback=jitter),
+                                          remote))
+            except ValueError as x:
+                raise Exception('Invalid schedule of {0}: {1}'.format(cfg_name, str(x)))
+    return PmonTargets(targets)
@@ -7,16 +7,31 @@
 #
 
 import json
+import queue
+import threading
 
-import requests
 import zmq
 
 import pmon
+from pmon.slack import PmonSlackForwarder
+
+# fields of a message, all of them are required
+MESSAGE_FIELDS = ('msg.type', 'from', 'msg')
 
 
 class ZmqResponder(object):
+    """
+    Receives messages on a ROUTER socket, so any number of REQ or
+    DEALER senders are served. Every message is acknowledged at once
+    and handed to a pool of worker threads through a bounded queue.
+    If the queue is full the message is refused with 'BUSY' and the
+    sender has to retry, a slow action never stalls the senders.
+    """
     context = None
     socket = None
+    messages = None
+    workers = None
+    slack = None
 
     def __init__(self):
         """
@@ -24,6 +39,12 @@ class ZmqResponder(object):
         """
         self.cfg = pmon.CFG
         self.log = pmon.LOG
+        self.messages = queue.Queue(self.cfg['pmon'].getint('zmq.queue.size', fallback=1000))
+        self.workers = list()
+        self.slack = PmonSlackForwarder(self.log,
+                                        self.cfg['pmon']['slack.hook'],
+                                        self.cfg['pmon'].getfloat('slack.window', fallback=1.0),
+                                        self.cfg['pmon'].getint('slack.retries', fallback=5))
 
     def __enter__(self):
         self.bind()
@@ -37,67 +58,84 @@ class ZmqResponder(object):
         port = self.cfg['pmon']['zmq.port']
         bind_str = "tcp://*:{0}".format(port)
         self.context = zmq.Context(1)
-        self.socket = self.context.socket(zmq.REP)
+        self.socket = self.context.socket(zmq.ROUTER)
+        self.socket.setsockopt(zmq.RCVHWM, self.messages.maxsize)
         self.socket.bind(bind_str)
+        for n in range(self.cfg['pmon'].getint('zmq.workers', fallback=4)):
+            worker = threading.Thread(target=self._work, name='pmon-zmq-{0}'.format(n), daemon=True)
+            worker.start()
+            self.workers.append(worker)
 
     def done(self):
         self.log.info("Disconnecting ZMQ")
+        # let the workers finish the accepted messages
+        for _ in self.workers:
+            self.messages.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.workers = list()
+        self.slack.close()
         if self.socket is not None:
             self.socket.close()
         if self.context is not None:
             self.context.term()
 
     def _read_message(self):
+        """
+        :return: (envelope, message), the envelope addresses the reply to the sender,
+                 the message is None if it is not valid JSON or lacks a field
+        """
         self.log.debug("Wait for incoming message")
-        msg = self.socket.recv()
-        _msg = msg.decode('utf-8')
-        return json.loads(_msg)
-
-    @staticmethod
-    def _make_slack_payload(message):
-        slack_payload = dict()
-        slack_payload['text'] = message['msg']
-        attachments = list()
-        slack_payload['attachments'] = attachments
-
-        attachment = dict()
-        attachment["fallback"] = message['msg']
-        attachment['text'] = message['msg']
-        attachment['title'] = message['msg.type']
-        attachment['author_name'] = message['from']
-
-        attachments.append(attachment)
-        return slack_payload
+        frames = self.socket.recv_multipart()
+        try:
+            message = json.loads(frames[-1].decode('utf-8'))
+        except (ValueError, UnicodeError) as x:
+            self.log.error("Invalid message: {0}".format(str(x)))
+            return frames[:-1], None
+        if not isinstance(message, dict):
+            self.log.error("Invalid message: no JSON object")
+            return frames[:-1], None
+        for field in MESSAGE_FIELDS:
+            if field not in message or isinstance(message[field], (dict, list)):
+                self.log.error("Invalid message: missing or structured field '{0}'".format(field))
+                return frames[:-1], None
+        return frames[:-1], message
+
+    def _reply(self, envelope, answer):
+        self.socket.send_multipart(envelope + [answer.encode('utf-8')])
+
+    def _work(self):
+        while True:
+            message = self.messages.get()
+            if message is None:
+                return
+            try:
+                self._report_message_to_slack(message)
+            except Exception as x:
+                self.log.error(str(x))
 
     def _report_message_to_slack(self, message):
         """
-        Send a message to Slack Web-Hook.
+        Queue a message for the Slack-Webhook.
         :param message: the message record to be send to slack
         :return:  None
         """
-        self.log.debug("Forwarding message to slack")
-        url = self.cfg['pmon']['slack.hook']
-        payload = json.dumps(self._make_slack_payload(message))
-        headers = {'Accept': 'application/json',
-                   'Content-Type': 'application/json',
-                   'Content-Encoding': 'utf8',
-                   'Content-Length': str(len(payload))}
-        try:
-            rsp = requests.post(url, data=payload, headers=headers)
-            if rsp.status_code != requests.codes.ok:
-                self.log.warn("problem sending to slack: {0}".format(rsp.status_code))
-        except Exception as x:
-            self.log.error(str(x))
+        self.slack.submit(message)
 
     def respond(self):
         go_on = True
         while go_on:
-            message = self._read_message()
+            envelope, message = self._read_message()
+            if message is None:
+                self._reply(envelope, 'ERROR')
+                continue
             self.log.debug("Message: {0}, {1}".format(message['msg.type'],
                                                       message['msg']))
-            self.socket.send_string('ACK')
             try:
-                self._report_message_to_slack(message)
-            except Exception as x:
-                self.log.error(str(x))
+                self.messages.put_nowait(message)
+            except queue.Full:
+                self.log.warning("Message refused, queue is full")
+                self._reply(envelope, 'BUSY')
+                continue
+            self._reply(envelope, 'ACK')
             go_on = True if message['msg'] != 'stop' else False
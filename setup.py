@@ -30,5 +30,8 @@ setuptools.setup(
         "paramiko",
         "cherrypy",
         "pyzmq"
-    )
+    ),
+    extras_require={
+        "async": ("aiohttp",)
+    }
 )
\ No newline at end of file